@@ -8,8 +8,9 @@ production-ready setup for the provided events.
 Note that this run its own merge and tombstone cleaning, which is NOT SAFE for multi-node setups without distributed
 locking.
 
-This example also provides async inserting via an in-memory buffer that flushes every 3 seconds. You must be able to
-tolerate data loss if the node dies, otherwise use something like RedPanda for buffering inserts.
+This example also provides async inserting via an in-memory buffer (IceDBBuffer) that flushes every 3 seconds. You must
+be able to tolerate data loss if the node dies, otherwise give the buffer a `wal_dir` on durable disk, or use something
+like RedPanda for buffering inserts.
 
 Run:
 `docker compose up -d`
@@ -39,6 +40,7 @@ curl http://localhost:8090/query
 
 from icedb.icedb import IceDBv3, CompressionCodec
 from icedb.log import IceLogIO
+from icedb.buffer import IceDBBuffer
 from datetime import datetime
 import json
 from time import time
@@ -51,7 +53,7 @@ import os
 
 class IceDBBatcher(object):
     """
-    Buffers inserted rows into memory and batch inserts them into icedb.
+    Buffers inserted rows into memory with an IceDBBuffer, which batch inserts them into icedb every insert interval.
 
     Runs merge on 10x the insert interval, and tombstone clean on 50x the insert interval.
 
@@ -59,46 +61,30 @@ class IceDBBatcher(object):
     """
 
     def __init__(self, icedb: IceDBv3, insert_interval_sec=3):
-        self._timer = None
         self._timer_merge = None
         self._timer_tombstone = None
         self.insert_interval_sec = insert_interval_sec
         self.icedb = icedb
-        self.is_running = False
+        self.buffer = IceDBBuffer(icedb, flush_interval_sec=insert_interval_sec)
         self.is_running_merge = False
         self.is_running_tombstone = False
         self.start()
-        self.rows = []
 
     def insert(self, rows: list[dict]):
-        # just append rows
-        self.rows = self.rows + rows
-
-    def _insert(self):
-        self.is_running = False
-        if len(self.rows) > 0:
-            try:
-                s = time()
-                self.icedb.insert(self.rows)
-                print("inserted in", time()-s)
-                self.rows = []
-            except Exception as e:
-                print("caught exception in _insert")
-                print(e)
-        self.start()
+        # blocks while the buffer is full
+        self.buffer.insert(rows)
 
     def _merge(self):
         self.is_running_merge = False
         try:
-            merged_log: str | None = ""
-            while merged_log is not None:
-                print("running merge")
-                s = time()
-                merged_log, _, _, _, _ = self.icedb.merge()
-                if merged_log is not None:
-                    print("merged in", time() - s)
-                else:
-                    print("no files merged")
+            print("running merge")
+            s = time()
+            # merges every partition that needs it, with a single log file
+            merged_log, plans, _ = self.icedb.merge_many()
+            if merged_log is not None:
+                print("merged", len(plans), "partitions in", time() - s)
+            else:
+                print("no files merged")
         except Exception as e:
             print("caught exception in _merge")
             print(e)
@@ -120,10 +106,6 @@ class IceDBBatcher(object):
         self.start()
 
     def start(self):
-        if not self.is_running:
-            self._timer = Timer(self.insert_interval_sec, self._insert)
-            self._timer.start()
-            self.is_running = True
         if not self.is_running_merge:
             self._timer_merge = Timer(self.insert_interval_sec * 10, self._merge)
             self._timer_merge.start()
@@ -134,10 +116,9 @@ class IceDBBatcher(object):
             self.is_running_tombstone = True
 
     def stop(self):
-        self._timer.cancel()
         self._timer_merge.cancel()
         self._timer_tombstone.cancel()
-        self.is_running = False
+        self.buffer.close()
         self.is_running_merge = False
         self.is_running_tombstone = False
 
@@ -89,13 +89,12 @@ def check_schema_conflicts(old: Schema, new: Schema):
                 raise SchemaConflictException(col, old[col], new[col])
 
 print("============= inserting events ==================")
-# Get initial schema
+# Get initial schema, this only reads the schema lines of the log files
 try:
-    s1, f1, t1, l1 = log.read_at_max_time(s3c, round(time() * 1000))
+    schema = log.read_schema(s3c)
 except NoLogFilesException as e:
     print("no log files yet, we will make a blank schema")
-
-schema = Schema()
+    schema = Schema()
 
 # First lets check if the schema is different
 new_schema = ice.get_schema(example_events)
@@ -1,5 +1,11 @@
 from .log import (
     IceLogIO, Schema, LogMetadata, LogTombstone, NoLogFilesException, FileMarker, S3Client,
-    LogMetadataFromJSON, FileMarkerFromJSON, LogTombstoneFromJSON, SchemaConflictException, get_log_file_info
+    LogMetadataFromJSON, FileMarkerFromJSON, LogTombstoneFromJSON, SchemaConflictException, get_log_file_info,
+    LogSnapshot, LogSnapshotFromJSON, LOG_VERSION_JSONL, LOG_VERSION_ARROW,
+    decompress_log_body, get_file_partition, FileMarkerSet
 )
-from .icedb import IceDBv3, PartitionFunctionType, CompressionCodec
+from .icedb import IceDBv3, PartitionFunctionType, PartitionExpressionType, CompressionCodec, MergeMode
+from .compaction import (
+    MergePlan, CompactionStrategy, DefaultCompaction, SizeTieredCompaction, LeveledCompaction, TimeWindowCompaction
+)
+from .buffer import IceDBBuffer, BufferFullException, BufferClosedException
@@ -0,0 +1,252 @@
+import json
+import os
+import threading
+from time import time
+from typing import Callable
+from uuid import uuid4
+from .icedb import IceDBv3
+from .log import FileMarker
+
+
+class BufferFullException(Exception):
+    """
+    Raised when rows could not be added to the buffer before the timeout, because too many rows were already waiting
+    to be inserted
+    """
+    pass
+
+
+class BufferClosedException(Exception):
+    pass
+
+
+class IceDBBuffer:
+    """
+    Buffers inserted rows in memory, and inserts them into IceDB in batches from a background thread once `max_rows`
+    rows are buffered, or every `flush_interval_sec`.
+
+    Producers block in `insert` while `max_buffered_rows` rows are waiting to be inserted (including a batch that is
+    being inserted or retried), so a slow or failing IceDB applies backpressure instead of growing memory without
+    bound. Each batch is inserted with its own `batch_id`, so a retry never duplicates it. A failed batch is retried
+    on its own (with the same rows and batch ID) on the next flush, up to `max_retries` times (forever if None), after
+    which it is dropped and passed to `on_drop` with the last exception, so a batch that can never be inserted does
+    not block producers forever.
+
+    If `wal_dir` is provided, rows are appended to a local write-ahead log before `insert` returns, and rows left in
+    it from a previous process (e.g. after a crash) are replayed into the buffer on startup. WAL segments are deleted
+    once their rows are inserted. Rows must be JSON serializable to use the WAL. Replaying is at-least-once: rows from
+    a batch that was inserted right before a crash, but whose segment was not yet deleted, are inserted again.
+    """
+    icedb: IceDBv3
+    max_rows: int
+    flush_interval_sec: float
+    max_buffered_rows: int
+    wal_dir: str | None
+    wal_fsync: bool
+    max_retries: int | None
+    on_drop: Callable[[list[dict], Exception], None] | None
+    last_error: Exception | None
+
+    def __init__(self, icedb: IceDBv3, max_rows: int = 100_000, flush_interval_sec: float = 3,
+                 max_buffered_rows: int = 1_000_000, wal_dir: str = None, wal_fsync: bool = False,
+                 max_retries: int | None = 10, on_drop: Callable[[list[dict], Exception], None] = None):
+        if max_rows < 1 or max_buffered_rows < max_rows:
+            raise AttributeError(f"invalid buffer sizes, max_rows ({max_rows}) must be at least 1 and no more than "
+                                 f"max_buffered_rows ({max_buffered_rows})")
+        self.icedb = icedb
+        self.max_rows = max_rows
+        self.flush_interval_sec = flush_interval_sec
+        self.max_buffered_rows = max_buffered_rows
+        self.wal_dir = wal_dir
+        self.wal_fsync = wal_fsync
+        self.max_retries = max_retries
+        self.on_drop = on_drop
+        self.last_error = None
+
+        self.rows: list[dict] = []
+        self.in_flight = 0  # rows of the batch currently being inserted
+        # the batch ID, rows, and WAL segments of a batch that failed to insert, and how many times it failed
+        self.failed: tuple[str, list[dict], list[str]] | None = None
+        self.attempts = 0
+        self.cond = threading.Condition()
+        self.flush_lock = threading.Lock()
+        self.closed = False
+
+        # WAL segments holding the rows in the buffer, the last one is being appended to
+        self.segments: list[str] = []
+        self.wal = None
+        self.wal_seq = 0
+        if wal_dir is not None:
+            os.makedirs(wal_dir, exist_ok=True)
+            self.__replay_wal()
+            self.__open_segment()
+
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+
+    def insert(self, rows: list[dict], timeout: float = None):
+        """
+        Adds rows to the buffer, waiting up to `timeout` seconds (forever if None) for room if `max_buffered_rows`
+        rows are already waiting to be inserted. Raises BufferFullException on timeout.
+        """
+        if len(rows) == 0:
+            return
+        deadline = None if timeout is None else time() + timeout
+        with self.cond:
+            while True:
+                if self.closed:
+                    raise BufferClosedException("the buffer is closed")
+                pending = len(self.rows) + self.in_flight + (0 if self.failed is None else len(self.failed[1]))
+                # a batch larger than the limit is let in once the buffer is empty, rather than waiting forever
+                if pending == 0 or pending + len(rows) <= self.max_buffered_rows:
+                    break
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    raise BufferFullException(f"{pending} rows are waiting to be inserted")
+                self.cond.wait(remaining)
+
+            if self.wal is not None:
+                self.wal.write(''.join(map(lambda x: json.dumps(x) + '\n', rows)))
+                self.wal.flush()
+                if self.wal_fsync:
+                    os.fsync(self.wal.fileno())
+
+            self.rows.extend(rows)
+            if len(self.rows) >= self.max_rows:
+                self.cond.notify_all()
+
+    def flush(self) -> list[FileMarker]:
+        """
+        Inserts the buffered rows now, returning the file markers inserted. A previously failed batch is retried
+        first. If an insert fails, the batch is kept to be retried (or dropped once it ran out of retries), and the
+        exception is raised.
+        """
+        with self.flush_lock:
+            file_markers: list[FileMarker] = []
+            if self.failed is not None:
+                file_markers += self.__insert_batch(*self.failed)
+
+            with self.cond:
+                batch, segments = self.rows, self.segments
+                if len(batch) == 0:
+                    return file_markers
+                self.rows = []
+                self.segments = []
+                self.in_flight = len(batch)
+                if self.wal is not None:
+                    self.__open_segment()
+            file_markers += self.__insert_batch(str(uuid4()), batch, segments)
+            return file_markers
+
+    def __insert_batch(self, batch_id: str, batch: list[dict], segments: list[str]) -> list[FileMarker]:
+        try:
+            # insert removes `_partition` from rows, so those are copied in case the batch needs to be retried
+            file_markers = self.icedb.insert(list(map(lambda x: dict(x) if "_partition" in x else x, batch)),
+                                             batch_id=batch_id)
+        except Exception as e:
+            with self.cond:
+                self.attempts += 1
+                dropped = self.max_retries is not None and self.attempts > self.max_retries
+                if dropped:
+                    self.failed = None
+                    self.attempts = 0
+                else:
+                    self.failed = (batch_id, batch, segments)
+                self.in_flight = 0
+                self.cond.notify_all()
+            if dropped:
+                self.__remove_segments(segments)
+                if self.on_drop is not None:
+                    self.on_drop(batch, e)
+                else:
+                    print(f"dropping {len(batch)} buffered rows after {self.max_retries} retries: {e}")
+            raise e
+
+        # the segments of a batch were all rotated out when it was taken, so nothing is still writing to them
+        self.__remove_segments(segments)
+        with self.cond:
+            self.failed = None
+            self.attempts = 0
+            self.in_flight = 0
+            self.cond.notify_all()
+        return file_markers
+
+    def __remove_segments(self, segments: list[str]):
+        for segment in segments:
+            os.remove(segment)
+
+    def close(self):
+        """
+        Stops the background thread and inserts the remaining rows. If that fails the exception is raised, and with a
+        WAL the rows are replayed the next time a buffer is created for it.
+        """
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        try:
+            self.flush()
+        finally:
+            if self.wal is not None:
+                self.wal.close()
+                self.wal = None
+                # remove the last segment if nothing was written to it
+                for segment in list(self.segments):
+                    if os.path.getsize(segment) == 0:
+                        os.remove(segment)
+                        self.segments.remove(segment)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __run(self):
+        while True:
+            with self.cond:
+                deadline = time() + self.flush_interval_sec
+                # after a failed insert wait out the interval even if the buffer is full, rather than retrying in a loop
+                while not self.closed and (self.last_error is not None or len(self.rows) < self.max_rows):
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                if self.closed:
+                    return
+            try:
+                self.flush()
+                self.last_error = None
+            except Exception as e:
+                self.last_error = e
+                print(f"exception inserting buffered rows, retrying in {self.flush_interval_sec}s: {e}")
+
+    def __open_segment(self):
+        """
+        Starts a new WAL segment for rows inserted from now on
+        """
+        if self.wal is not None:
+            self.wal.close()
+        self.wal_seq += 1
+        segment = os.path.join(self.wal_dir, f"wal-{self.wal_seq:020d}.jsonl")
+        self.wal = open(segment, 'a', encoding='utf-8')
+        self.segments.append(segment)
+
+    def __replay_wal(self):
+        """
+        Loads the rows of any WAL segments left by a previous process into the buffer, in the order they were written
+        """
+        names = sorted(filter(lambda x: x.startswith("wal-") and x.endswith(".jsonl"), os.listdir(self.wal_dir)))
+        for name in names:
+            segment = os.path.join(self.wal_dir, name)
+            with open(segment, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self.rows.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # a partially written row from a crash, which insert never returned for
+                        continue
+            self.segments.append(segment)
+            self.wal_seq = max(self.wal_seq, int(name[len("wal-"):-len(".jsonl")]))
@@ -0,0 +1,293 @@
+from abc import ABC, abstractmethod
+from typing import Dict
+from time import time
+from .log import FileMarker, FileMarkerSet
+
+
+class MergePlan:
+    """
+    The files of a partition picked to be merged into a single file. `new_file_marker` is set once it is merged.
+
+    The merged file is created at the merge time, unless `created_ms` is set. `partition_file_count` is the number of
+    alive files the partition had when planned.
+    """
+    partition: str
+    file_markers: list[FileMarker]
+    created_ms: int | None
+    partition_file_count: int | None
+    new_file_marker: FileMarker | None
+
+    def __init__(self, partition: str, file_markers: list[FileMarker], created_ms: int = None,
+                 partition_file_count: int = None):
+        self.partition = partition
+        self.file_markers = file_markers
+        self.created_ms = created_ms
+        self.partition_file_count = partition_file_count
+        self.new_file_marker = None
+
+    def file_bytes(self) -> int:
+        """
+        The bytes the merge reads
+        """
+        return sum(map(lambda x: x.fileBytes, self.file_markers))
+
+    def estimated_output_bytes(self, ratio: float = 1.0) -> int:
+        """
+        The estimated size of the merged file, `ratio` times the size of the files merged. Merging sorted files of the
+        same partition typically compresses at least as well, so the default is an upper bound unless a custom merge
+        query adds data.
+        """
+        return round(self.file_bytes() * ratio)
+
+    def file_count_reduction(self) -> int:
+        """
+        How many fewer files the partition has after the merge
+        """
+        return len(self.file_markers) - 1
+
+    def read_reduction(self) -> float | None:
+        """
+        The fraction of the partition's files that queries no longer read after the merge, higher means the merge helps
+        reads more
+        """
+        if not self.partition_file_count:
+            return None
+        return self.file_count_reduction() / self.partition_file_count
+
+    def __repr__(self):
+        return f"MergePlan({self.partition}, {len(self.file_markers)} files, {self.file_bytes()} bytes)"
+
+
+class CompactionStrategy(ABC):
+    """
+    Decides which files merge combines. Partitions are visited in the order of `order`, and `select` picks the groups of
+    alive files in a partition that are each merged into a single file.
+
+    Subclasses must implement `select`, and can override `order`.
+    """
+
+    def plan(self, partitions: Dict[str, FileMarkerSet], max_partitions: int = None) -> list[MergePlan]:
+        """
+        Returns the merge plans for up to `max_partitions` partitions (all of them if None)
+        """
+        plans: list[MergePlan] = []
+        planned_partitions = 0
+        for partition, file_markers in self.order(partitions):
+            if max_partitions is not None and planned_partitions >= max_partitions:
+                break
+            if len(file_markers) <= 1:
+                continue
+            alive = list(file_markers.alive())
+            groups = list(filter(lambda x: len(x) > 1, self.select(partition, alive)))
+            if len(groups) == 0:
+                # this partition had nothing to merge
+                continue
+            for group in groups:
+                plan = self.plan_group(partition, group)
+                plan.partition_file_count = len(alive)
+                plans.append(plan)
+            planned_partitions += 1
+        return plans
+
+    def order(self, partitions: Dict[str, FileMarkerSet]) -> list[tuple[str, FileMarkerSet]]:
+        """
+        The order partitions are considered in, by default the ones with the most files first
+        """
+        return sorted(partitions.items(), key=lambda item: len(item[1]), reverse=True)
+
+    @abstractmethod
+    def select(self, partition: str, file_markers: list[FileMarker]) -> list[list[FileMarker]]:
+        """
+        Returns the groups of files to merge in the partition, groups with less than 2 files are ignored
+        """
+        pass
+
+    def plan_group(self, partition: str, file_markers: list[FileMarker]) -> MergePlan:
+        return MergePlan(partition, file_markers)
+
+
+class DefaultCompaction(CompactionStrategy):
+    """
+    The original merge behavior: the smallest files of a partition are merged until their total reaches
+    `max_file_size`, or there are `max_file_count` of them. Partitions with the most files are merged first, or the
+    fewest with `asc`.
+    """
+    max_file_size: int
+    max_file_count: int
+    asc: bool
+
+    def __init__(self, max_file_size=10_000_000, max_file_count=10, asc=False):
+        self.max_file_size = max_file_size
+        self.max_file_count = max_file_count
+        self.asc = asc
+
+    def order(self, partitions: Dict[str, FileMarkerSet]) -> list[tuple[str, FileMarkerSet]]:
+        return sorted(partitions.items(), key=lambda item: len(item[1]), reverse=not self.asc)
+
+    def select(self, partition: str, file_markers: list[FileMarker]) -> list[list[FileMarker]]:
+        return [accumulate_smallest(file_markers, self.max_file_size, self.max_file_count)]
+
+
+class SizeTieredCompaction(CompactionStrategy):
+    """
+    Buckets the files of a partition by similar size (within `bucket_low` to `bucket_high` times the average of the
+    bucket, and all files under `min_file_bytes` together), and merges the bucket with the most files once it has at
+    least `min_threshold`, up to `max_threshold` files (and `max_file_bytes` in total if set).
+
+    Files are only rewritten when merged with files of a similar size, so write amplification is low, at the cost of
+    partitions keeping several files of each size (more files to read).
+    """
+    min_threshold: int
+    max_threshold: int
+    bucket_low: float
+    bucket_high: float
+    min_file_bytes: int
+    max_file_bytes: int | None
+
+    def __init__(self, min_threshold=4, max_threshold=32, bucket_low=0.5, bucket_high=1.5, min_file_bytes=1_000_000,
+                 max_file_bytes: int = None):
+        if min_threshold < 2 or max_threshold < min_threshold:
+            raise AttributeError(f"invalid thresholds, min_threshold ({min_threshold}) must be at least 2 and no more "
+                                 f"than max_threshold ({max_threshold})")
+        self.min_threshold = min_threshold
+        self.max_threshold = max_threshold
+        self.bucket_low = bucket_low
+        self.bucket_high = bucket_high
+        self.min_file_bytes = min_file_bytes
+        self.max_file_bytes = max_file_bytes
+
+    def select(self, partition: str, file_markers: list[FileMarker]) -> list[list[FileMarker]]:
+        small: list[FileMarker] = []
+        buckets: list[list[FileMarker]] = []
+        bucket_bytes = 0
+        for file_marker in sorted(file_markers, key=lambda item: item.fileBytes):
+            if file_marker.fileBytes < self.min_file_bytes:
+                small.append(file_marker)
+                continue
+            if len(buckets) > 0:
+                avg = bucket_bytes / len(buckets[-1])
+                if avg * self.bucket_low <= file_marker.fileBytes <= avg * self.bucket_high:
+                    buckets[-1].append(file_marker)
+                    bucket_bytes += file_marker.fileBytes
+                    continue
+            buckets.append([file_marker])
+            bucket_bytes = file_marker.fileBytes
+
+        candidates = list(filter(lambda x: len(x) >= self.min_threshold, [small] + buckets))
+        if len(candidates) == 0:
+            return []
+        # the bucket with the most files, preferring the smallest files on ties
+        bucket = max(candidates, key=lambda x: len(x))
+        return [accumulate_smallest(bucket, self.max_file_bytes, self.max_threshold)]
+
+
+class LeveledCompaction(CompactionStrategy):
+    """
+    Sorts the files of a partition into levels by size, level 0 being files under `base_file_bytes`, and each level
+    holding files up to `fanout` times larger than the previous. Once level 0 has `level0_file_count` files, or a
+    higher level has `fanout` files, they are merged together with the smallest file of the next level if the result
+    still fits in that level (up to `max_file_bytes` in total if set).
+
+    Files keep being merged into larger ones as they grow, so each partition converges to a few files per level (fewer
+    files to read), at the cost of rewriting large files more often.
+    """
+    base_file_bytes: int
+    fanout: int
+    level0_file_count: int
+    max_file_bytes: int | None
+
+    def __init__(self, base_file_bytes=10_000_000, fanout=10, level0_file_count=4, max_file_bytes: int = None):
+        if fanout < 2 or level0_file_count < 2:
+            raise AttributeError(f"invalid leveled compaction, fanout ({fanout}) and level0_file_count "
+                                 f"({level0_file_count}) must be at least 2")
+        self.base_file_bytes = base_file_bytes
+        self.fanout = fanout
+        self.level0_file_count = level0_file_count
+        self.max_file_bytes = max_file_bytes
+
+    def level(self, file_bytes: int) -> int:
+        level = 0
+        limit = self.base_file_bytes
+        while file_bytes >= limit:
+            level += 1
+            limit *= self.fanout
+        return level
+
+    def level_limit(self, level: int) -> int:
+        """
+        The size files of the level are below
+        """
+        return self.base_file_bytes * self.fanout ** level
+
+    def select(self, partition: str, file_markers: list[FileMarker]) -> list[list[FileMarker]]:
+        levels: Dict[int, list[FileMarker]] = {}
+        for file_marker in sorted(file_markers, key=lambda item: item.fileBytes):
+            levels.setdefault(self.level(file_marker.fileBytes), []).append(file_marker)
+
+        for level in sorted(levels.keys()):
+            files = levels[level]
+            if len(files) < (self.level0_file_count if level == 0 else self.fanout):
+                continue
+            group = accumulate_smallest(files, self.max_file_bytes, len(files))
+            group_bytes = sum(map(lambda x: x.fileBytes, group))
+            next_level = levels.get(level + 1, [])
+            if len(next_level) > 0 and group_bytes + next_level[0].fileBytes < self.level_limit(level + 1) and \
+                    (self.max_file_bytes is None or group_bytes + next_level[0].fileBytes <= self.max_file_bytes):
+                group.append(next_level[0])
+            return [group]
+        return []
+
+
+class TimeWindowCompaction(CompactionStrategy):
+    """
+    Only merges files created in the same `window_ms` window, each window independently (like `DefaultCompaction`,
+    up to `max_file_size` and `max_file_count`), so recent and historical data are never rewritten together. The
+    merged file keeps the latest creation time of its files, so it stays in its window.
+
+    The current window, which is still receiving inserts, is only merged once it has `active_min_files` files, so hot
+    partitions are not rewritten on every merge while older windows are compacted down to single files.
+    """
+    window_ms: int
+    max_file_size: int
+    max_file_count: int
+    active_min_files: int
+
+    def __init__(self, window_ms=3_600_000, max_file_size=100_000_000, max_file_count=100, active_min_files=4):
+        if window_ms < 1:
+            raise AttributeError(f"invalid window {window_ms}, must be at least 1ms")
+        self.window_ms = window_ms
+        self.max_file_size = max_file_size
+        self.max_file_count = max_file_count
+        self.active_min_files = active_min_files
+
+    def select(self, partition: str, file_markers: list[FileMarker]) -> list[list[FileMarker]]:
+        windows: Dict[int, list[FileMarker]] = {}
+        for file_marker in file_markers:
+            windows.setdefault(file_marker.createdMS // self.window_ms, []).append(file_marker)
+
+        groups: list[list[FileMarker]] = []
+        active_window = round(time() * 1000) // self.window_ms
+        for window in sorted(windows.keys()):
+            files = windows[window]
+            if window == active_window and len(files) < self.active_min_files:
+                continue
+            groups.append(accumulate_smallest(files, self.max_file_size, self.max_file_count))
+        return groups
+
+    def plan_group(self, partition: str, file_markers: list[FileMarker]) -> MergePlan:
+        return MergePlan(partition, file_markers, max(map(lambda x: x.createdMS, file_markers)))
+
+
+def accumulate_smallest(file_markers: list[FileMarker], max_bytes: int | None, max_count: int) -> list[FileMarker]:
+    """
+    Takes files smallest first until their total reaches `max_bytes` (if not None), or there are `max_count` of them
+    """
+    acc_bytes = 0
+    acc_file_markers: list[FileMarker] = []
+    for file_marker in sorted(file_markers, key=lambda item: item.fileBytes):
+        acc_bytes += file_marker.fileBytes
+        acc_file_markers.append(file_marker)
+        if max_bytes is not None and acc_bytes >= max_bytes or \
+                len(acc_file_markers) > 1 and len(acc_file_markers) >= max_count:
+            break
+    return acc_file_markers
@@ -1,15 +1,24 @@
 import os
-from typing import List, Callable, Dict
+from typing import List, Callable, Dict, Iterable, Iterator
 import duckdb
-from uuid import uuid4
+from uuid import uuid4, uuid5, NAMESPACE_URL
 from .log import (IceLogIO, Schema, LogMetadata, S3Client, FileMarker, LogTombstone, get_log_file_info,
-                 LogMetadataFromJSON, LogTombstoneFromJSON, FileMarkerFromJSON)
+                 FileMarkerFromJSON, LOG_VERSION_JSONL, get_file_partition, FileMarkerSet)
 from time import time, sleep
 import json
 from enum import Enum
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import re
 from copy import deepcopy
 import concurrent.futures
+import threading
+import tempfile
+from contextlib import contextmanager
+from boto3.s3.transfer import TransferConfig
+from .compaction import MergePlan, CompactionStrategy, DefaultCompaction
+from .parquet import concat_files, PARQUET_CODECS
 
 
 class CompressionCodec(Enum):
@@ -19,11 +28,154 @@ class CompressionCodec(Enum):
     GZIP = "GZIP"
 
 
+class MergeMode(Enum):
+    """
+    How merges without a custom merge query combine files.
+
+    SORTED streams the (already sorted) files through a k-way merge on the sort order, so merged files stay sorted
+    with bounded memory. DUCKDB has DuckDB read and write all the files, without sorting. PASSTHROUGH concatenates the
+    row groups of the files without decoding them when possible (so data is only sorted within each row group), and
+    otherwise merges like SORTED. That includes files whose row groups average less than `PASSTHROUGH_MIN_ROW_GROUP_FILL`
+    of the row group size, so merging many small files does not produce a file of many small row groups.
+    """
+    SORTED = "SORTED"
+    DUCKDB = "DUCKDB"
+    PASSTHROUGH = "PASSTHROUGH"
+
+
 PartitionFunctionType = Callable[[dict], str]
+PartitionExpressionType = str
 PartitionRemovalFunctionType = Callable[[list[str]], list[str]]
 
+# Fraction of `row_group_size` the row groups of files must average for MergeMode.PASSTHROUGH to concatenate them
+PASSTHROUGH_MIN_ROW_GROUP_FILL = 0.25
+
+# Max number of Arrow schemas to keep the DuckDB types of, the cache is cleared when full
+SCHEMA_CACHE_SIZE = 1024
+
+# DuckDB readers for insert_files
+FILE_READERS = {
+    "csv": "read_csv_auto",
+    "json": "read_json_auto",
+    "parquet": "read_parquet",
+}
+
+
+def get_file_format(path: str) -> str:
+    """
+    Infers the insert_files format of a path from its extension, ignoring a compression extension
+    """
+    parts = path.lower().split('.')
+    if len(parts) > 2 and parts[-1] in ("gz", "zst"):
+        parts = parts[:-1]
+    ext = parts[-1]
+    if ext in ("csv", "tsv"):
+        return "csv"
+    if ext in ("json", "jsonl", "ndjson"):
+        return "json"
+    if ext == "parquet":
+        return "parquet"
+    raise AttributeError(f"cannot infer the file format of '{path}', provide the format")
+
+
+def get_sort_column(sort_key: str, columns: list[str]) -> str | None:
+    """
+    Returns the column a sort order entry sorts by, if it is a plain (optionally double quoted) column name of one of
+    the columns, otherwise None
+    """
+    sort_key = sort_key.strip()
+    if len(sort_key) > 1 and sort_key[0] == '"' and sort_key[-1] == '"':
+        name = sort_key[1:-1].replace('""', '"')
+        return name if name in columns else None
+    if re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", sort_key) is None:
+        return None
+    # unquoted identifiers are case insensitive in DuckDB
+    matches = list(filter(lambda x: x.lower() == sort_key.lower(), columns))
+    return matches[0] if len(matches) == 1 else None
+
+
+def conform_table(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """
+    Returns the table with the columns of the schema, adding missing columns as nulls
+    """
+    columns = []
+    for field in schema:
+        if field.name in table.column_names:
+            column = table.column(field.name)
+            columns.append(column if column.type == field.type else column.cast(field.type))
+        else:
+            columns.append(pa.nulls(table.num_rows, field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+def merge_sorted(inputs: list[Iterator[pa.Table]], sort_keys: list[str]) -> Iterator[pa.Table]:
+    """
+    k-way merges tables from iterators that each yield rows sorted by the sort keys (ascending, nulls last) into
+    sorted tables. The tables of all inputs must have the same schema.
+
+    Only one table per input is held at a time: each round sorts the pending rows of every input, and emits the rows up
+    to the largest pending row of the input whose largest row is smallest, since no input can still produce rows
+    before it. That input then reads its next table.
+    """
+    sort_by = list(map(lambda x: (x, "ascending"), sort_keys))
+    pending: list[pa.Table | None] = [None] * len(inputs)
+    exhausted = [False] * len(inputs)
+
+    while True:
+        for i, it in enumerate(inputs):
+            while not exhausted[i] and (pending[i] is None or pending[i].num_rows == 0):
+                pending[i] = next(it, None)
+                if pending[i] is None:
+                    exhausted[i] = True
+
+        active = list(filter(lambda x: pending[x] is not None and pending[x].num_rows > 0, range(len(inputs))))
+        if len(active) == 0:
+            return
+        if len(active) == 1 and all(map(lambda x: exhausted[x] or x == active[0], range(len(inputs)))):
+            # only one input left, which is already sorted
+            yield pending[active[0]]
+            pending[active[0]] = None
+            continue
+
+        table = pa.concat_tables(map(lambda x: pending[x], active))
+        ids = pa.concat_arrays(list(map(lambda x: pa.array([x] * pending[x].num_rows, pa.int32()), active)))
+        # nulls are placed at the end by default
+        order = pc.sort_indices(table, sort_keys=sort_by)
+        table = table.take(order)
+        ids = ids.take(order)
+
+        # the position of each input's largest pending row in the sorted rows
+        last_rows = {}
+        for i in active:
+            last_rows[i] = pc.indices_nonzero(pc.equal(ids, i))[-1].as_py()
+        constraining = list(filter(lambda x: not exhausted[x], active))
+        frontier = min(map(lambda x: last_rows[x], constraining)) if len(constraining) > 0 else table.num_rows - 1
+
+        yield table.slice(0, frontier + 1)
+        rest = table.slice(frontier + 1)
+        rest_ids = ids.slice(frontier + 1)
+        for i in active:
+            pending[i] = rest.filter(pc.equal(rest_ids, i))
+
+
+def rows_to_table(rows: list[dict]) -> pa.Table:
+    """
+    Builds a table with the union of the keys of the rows as columns, unlike `pa.Table.from_pylist` which only infers
+    the columns of the first row
+    """
+    columns = dict.fromkeys(key for row in rows for key in row)
+    return pa.Table.from_pydict({column: list(map(lambda x: x.get(column), rows)) for column in columns})
+
+
+def sql_string(s: str) -> str:
+    """
+    Quotes a string as a SQL literal
+    """
+    return "'{}'".format(s.replace("'", "''"))
+
+
 class IceDBv3:
-    partition_function: PartitionFunctionType
+    partition_function: PartitionFunctionType | PartitionExpressionType
     sort_order: List[str]
     data_s3c: S3Client
     log_s3c: S3Client
@@ -34,11 +186,24 @@ class IceDBv3:
     compression_codec: CompressionCodec
     preserve_partition: bool
     max_threads: int
+    log_read_concurrency: int
+    logio: IceLogIO
+    log_version: int
+    log_compression: str | None
     duckdb_ext_dir: str
+    duckdb_pool_size: int
+    duckdb_threads: int | None
+    duckdb_memory_limit: str | None
+    local_upload: bool
+    upload_tmp_dir: str | None
+    upload_config: TransferConfig
+    merge_mode: MergeMode
+    max_rows_per_file: int | None
+    target_file_bytes: int | None
 
     def __init__(
             self,
-            partition_function: PartitionFunctionType,
+            partition_function: PartitionFunctionType | PartitionExpressionType,
             sort_order: List[str],
             s3_region: str,
             s3_access_key: str,
@@ -54,7 +219,23 @@ class IceDBv3:
             compression_codec: CompressionCodec = CompressionCodec.SNAPPY,
             preserve_partition: bool = False,
             max_threads: int = os.cpu_count(),
-            log_s3_client: S3Client = None
+            log_s3_client: S3Client = None,
+            log_read_concurrency: int = 1,
+            log_snapshot_cache: bool = False,
+            log_snapshot_cache_dir: str = None,
+            log_use_checkpoints: bool = False,
+            log_version: int = LOG_VERSION_JSONL,
+            log_compression: str = None,
+            duckdb_pool_size: int = None,
+            duckdb_threads: int = None,
+            duckdb_memory_limit: str = None,
+            local_upload: bool = False,
+            upload_concurrency: int = 10,
+            upload_part_size: int = 8 * 1024 * 1024,
+            upload_tmp_dir: str = None,
+            max_rows_per_file: int = None,
+            target_file_bytes: int = None,
+            merge_mode: MergeMode = MergeMode.SORTED
     ):
         self.partition_function = partition_function
         self.sort_order = sort_order
@@ -65,23 +246,63 @@ class IceDBv3:
         self.custom_insert_query = custom_insert_query
         self.preserve_partition = preserve_partition
         self.max_threads = max_threads
+        self.log_read_concurrency = log_read_concurrency
         self.duckdb_ext_dir = duckdb_ext_dir
         self.s3_region = s3_region
         self.s3_access_key = s3_access_key
         self.s3_secret_key = s3_secret_key
         self.s3_endpoint = s3_endpoint
         self.s3_use_path = s3_use_path
+        self.duckdb_threads = duckdb_threads
+        self.duckdb_memory_limit = duckdb_memory_limit
+
+        # DuckDB sessions are configured once and reused, insert uses up to max_threads at a time
+        self.duckdb_pool_size = duckdb_pool_size if duckdb_pool_size is not None else max_threads
+        if self.duckdb_pool_size < 1:
+            raise AttributeError(f"invalid duckdb pool size {self.duckdb_pool_size}, must be at least 1")
+        self.duckdb_pool = []  # idle sessions
+        self.duckdb_pool_cond = threading.Condition()
+        self.duckdb_pool_created = 0
+
+        # DuckDB types of inserted Arrow schemas, see __describe
+        self.schema_cache = {}
+        self.schema_cache_lock = threading.Lock()
+
+        # parquet files are either written through httpfs, or written locally and uploaded with boto3
+        self.local_upload = local_upload
+        self.upload_tmp_dir = upload_tmp_dir
+        self.upload_config = TransferConfig(multipart_threshold=upload_part_size, multipart_chunksize=upload_part_size,
+                                            max_concurrency=upload_concurrency)
+
+        # large partitions are split into several files on insert
+        if max_rows_per_file is not None and max_rows_per_file < 1:
+            raise AttributeError(f"invalid max rows per file {max_rows_per_file}, must be at least 1")
+        if target_file_bytes is not None and target_file_bytes < 1:
+            raise AttributeError(f"invalid target file bytes {target_file_bytes}, must be at least 1")
+        self.max_rows_per_file = max_rows_per_file
+        self.target_file_bytes = target_file_bytes
 
         if log_s3_client is not None:
             self.log_s3c = log_s3_client
         else:
             self.log_s3c = s3_client
 
+        # kept for the lifetime of the instance so the snapshot cache can be reused across operations
+        self.log_version = log_version
+        self.log_compression = log_compression
+        self.logio = IceLogIO(path_safe_hostname, log_read_concurrency, log_snapshot_cache, log_snapshot_cache_dir,
+                              log_use_checkpoints, compression=log_compression)
+
         if not isinstance(compression_codec, CompressionCodec):
             raise AttributeError(f"invalid compression codec '{compression_codec}', must be one of type CompressionCodec")
 
         self.compression_codec = compression_codec
 
+        if not isinstance(merge_mode, MergeMode):
+            raise AttributeError(f"invalid merge mode '{merge_mode}', must be one of type MergeMode")
+
+        self.merge_mode = merge_mode
+
     def get_duckdb(self) -> duckdb:
         """
         threadsafe creation of a duckdb session
@@ -98,93 +319,367 @@ class IceDBv3:
             ddb.execute("SET s3_url_style='path'")
         if self.duckdb_ext_dir is not None:
             ddb.execute(f"SET extension_directory='{self.duckdb_ext_dir}'")
+        if self.duckdb_threads is not None:
+            ddb.execute(f"SET threads={self.duckdb_threads}")
+        if self.duckdb_memory_limit is not None:
+            ddb.execute(f"SET memory_limit='{self.duckdb_memory_limit}'")
         return ddb
 
-    def __get_file_partition(self, full_path: str) -> str:
-        base_path = full_path.split("_data/")[1]
-        path_parts = base_path.split("/")
-        # remove the file name
-        partition = '/'.join(path_parts[:-1])
-        return partition
+    @contextmanager
+    def duckdb_session(self):
+        """
+        threadsafe borrowing of a configured duckdb session from the pool, returning it when done. Up to
+        `duckdb_pool_size` sessions are created (each set up once with `get_duckdb`), and callers wait for one to be
+        returned beyond that.
 
-    def get_schema(self, rows: list[dict]) -> Schema:
-        running_schema = Schema()
+        Sessions that raise an exception are closed rather than returned, in case they were left in a bad state, and a
+        waiting caller is woken to create a new one in their place.
+        """
+        ddb = None
+        with self.duckdb_pool_cond:
+            while len(self.duckdb_pool) == 0 and self.duckdb_pool_created >= self.duckdb_pool_size:
+                self.duckdb_pool_cond.wait()
+            if len(self.duckdb_pool) > 0:
+                ddb = self.duckdb_pool.pop()
+            else:
+                self.duckdb_pool_created += 1
+
+        returned = False
+        try:
+            if ddb is None:
+                ddb = self.get_duckdb()
+            yield ddb
+            returned = True
+        finally:
+            # also runs for BaseExceptions like KeyboardInterrupt, so the slot is never leaked
+            if not returned and ddb is not None:
+                ddb.close()
+            with self.duckdb_pool_cond:
+                if returned:
+                    self.duckdb_pool.append(ddb)
+                else:
+                    self.duckdb_pool_created -= 1
+                self.duckdb_pool_cond.notify()
 
+    def get_schema(self, rows: list[dict]) -> Schema:
         # py arrow table
-        _rows = pa.Table.from_pylist(rows)
+        _rows = rows_to_table(rows)
 
-        # get schema
-        ddb = self.get_duckdb()
-        ddb.execute("describe {}".format("select * from _rows" if self.custom_insert_query is None
-                                                         else self.custom_insert_query))
-        schema_arrow = ddb.arrow()
-        running_schema.accumulate(list(map(lambda x: str(x), schema_arrow.column('column_name'))), list(map(lambda x:
-         str(x), schema_arrow.column('column_type'))))
-        return running_schema
+        return self.__describe(_rows, "select * from _rows" if self.custom_insert_query is None
+                               else self.custom_insert_query)
+
+    def __describe(self, _rows: pa.Table, query: str = "select * from _rows") -> Schema:
+        """
+        Returns the DuckDB schema of the query over `_rows`. The DuckDB types only depend on the Arrow schema, so
+        they are memoized by it (and the query), and DuckDB is only asked to describe an empty slice of the table the
+        first time a schema is seen.
+        """
+        key = (_rows.schema.remove_metadata(), query)
+        with self.schema_cache_lock:
+            cached = self.schema_cache.get(key)
+        if cached is None:
+            with self.duckdb_session() as ddb:
+                ddb.register("_rows", _rows.slice(0, 0))
+                try:
+                    ddb.execute(f"describe {query}")
+                    schema_arrow = ddb.arrow()
+                finally:
+                    ddb.unregister("_rows")
+            cached = (list(map(lambda x: str(x), schema_arrow.column('column_name'))),
+                      list(map(lambda x: str(x), schema_arrow.column('column_type'))))
+            with self.schema_cache_lock:
+                if len(self.schema_cache) >= SCHEMA_CACHE_SIZE:
+                    self.schema_cache.clear()
+                self.schema_cache[key] = cached
 
-    def __insert_part(self, part: str, part_ref: list[dict]) -> tuple[FileMarker, Schema]:
         running_schema = Schema()
+        running_schema.accumulate(cached[0], cached[1])
+        return running_schema
+
+    def __insert_part(self, part: str, _rows: pa.Table, file_id: str = None) -> tuple[FileMarker, Schema]:
+        # get schema
+        running_schema = self.__describe(_rows)
 
         # upload parquet file
-        filename = str(uuid4()) + '.parquet'
+        filename = (str(uuid4()) if file_id is None else file_id) + '.parquet'
         path_parts = ['_data', part, filename]
         if self.data_s3c.s3prefix is not None:
             path_parts = [self.data_s3c.s3prefix] + path_parts
         fullpath = '/'.join(path_parts)
 
-        # py arrow table for inserting into duckdb
-        _rows = pa.Table.from_pylist(part_ref)
-
-        # get schema
-        ddb = self.get_duckdb()
-        ddb.execute("describe select * from _rows")
-        schema_arrow = ddb.arrow()
-        running_schema.accumulate(list(map(lambda x: str(x), schema_arrow.column('column_name'))),
-                                  list(map(lambda x: str(x), schema_arrow.column('column_type'))))
-
-        # copy to parquet file
-        retries = 0
-        while retries < 3:
+        with self.duckdb_session() as ddb:
+            ddb.register("_rows", _rows)
             try:
-                # if retries > 0:
-                    # print(f"retrying duckdb s3 upload try {retries}")
-                ddb.execute("""
-                            copy ({}) to 's3://{}/{}' (format parquet, codec '{}', row_group_size {})
-                            """.format(
-                    'select * from _rows order by {}'.format(
-                        ','.join(self.sort_order)) if self.custom_insert_query is None else self.custom_insert_query,
-                    self.data_s3c.s3bucket,
-                    fullpath,
-                    self.compression_codec.value,
-                    self.row_group_size
-                ))
-                break
-            except duckdb.HTTPException as e:
-                if e.status_code < 500 and e.status_code != 429:
-                    raise e
-                if retries >= 3:
-                    raise e
-                retries += 1
-                print(f"HTTP exception (code {e.status_code}) uploading part on try {retries}, sleeping "
-                      f"{300*retries}ms before retrying")
-                sleep(0.3*retries)
-            except Exception as e:
-                raise e
+                # copy to parquet file
+                retries = 0
+                while retries < 3:
+                    try:
+                        # if retries > 0:
+                            # print(f"retrying duckdb s3 upload try {retries}")
+                        file_bytes = self.__write_parquet(ddb, 'select * from _rows order by {}'.format(
+                            ','.join(self.sort_order)) if self.custom_insert_query is None else self.custom_insert_query,
+                                                          fullpath)
+                        break
+                    except duckdb.HTTPException as e:
+                        if e.status_code < 500 and e.status_code != 429:
+                            raise e
+                        if retries >= 3:
+                            raise e
+                        retries += 1
+                        print(f"HTTP exception (code {e.status_code}) uploading part on try {retries}, sleeping "
+                              f"{300*retries}ms before retrying")
+                        sleep(0.3*retries)
+                    except Exception as e:
+                        raise e
+            finally:
+                ddb.unregister("_rows")
 
         insert_time = round(time() * 1000)
+        return FileMarker(fullpath, insert_time, file_bytes), running_schema
 
-        # get file metadata
-        obj = self.data_s3c.s3.head_object(
-            Bucket=self.data_s3c.s3bucket,
-            Key=fullpath
-        )
-        return FileMarker(fullpath, insert_time, obj['ContentLength']), running_schema
+    def __write_parquet(self, ddb: duckdb.DuckDBPyConnection, query: str, fullpath: str, params: list = None) -> int:
+        """
+        Writes the result of the query to the data bucket as a parquet file, returning its size in bytes.
 
-    def insert(self, rows: list[dict]) -> list[FileMarker]:
+        With `local_upload`, DuckDB writes a local temporary file which is uploaded with concurrent multipart parts,
+        and the size comes from the file. Otherwise DuckDB writes it directly through httpfs, and the size is fetched
+        with a HEAD request.
+        """
+        copy_options = "(format parquet, codec '{}', row_group_size {})".format(self.compression_codec.value,
+                                                                                self.row_group_size)
+        if not self.local_upload:
+            ddb.execute("copy ({}) to 's3://{}/{}' {}".format(query, self.data_s3c.s3bucket, fullpath, copy_options),
+                        params)
+            obj = self.data_s3c.s3.head_object(
+                Bucket=self.data_s3c.s3bucket,
+                Key=fullpath
+            )
+            return obj['ContentLength']
+
+        fd, local_path = tempfile.mkstemp(suffix='.parquet', dir=self.upload_tmp_dir)
+        os.close(fd)
+        try:
+            ddb.execute("copy ({}) to '{}' {}".format(query, local_path, copy_options), params)
+            self.data_s3c.s3.upload_file(local_path, self.data_s3c.s3bucket, fullpath, Config=self.upload_config)
+            return os.path.getsize(local_path)
+        finally:
+            os.remove(local_path)
+
+    def insert(self, rows: list[dict], batch_id: str = None) -> list[FileMarker]:
         """
         Creates one or more files in the destination folder based on the partition strategy :param rows: Rows of JSON
         data to be inserted. Must have the expected keys of the partitioning strategy and the sorting order
+
+        If a `batch_id` is provided the insert is idempotent: retrying it with the same batch ID and rows never
+        duplicates data. If the batch was already committed its file markers are returned without writing anything,
+        otherwise data files are written to the same (deterministic) paths and committed. See ARCHITECTURE.md.
+        """
+        if batch_id is not None:
+            committed = self.__get_committed_batch(batch_id)
+            if committed is not None:
+                return committed
+            # partitioning removes `_partition` from rows, which a retry needs to find the same partitions
+            rows = list(map(lambda x: dict(x) if "_partition" in x else x, rows))
+        return self.__insert_parts(self.__partition_rows(rows), batch_id)
+
+    def insert_arrow(self, data: pa.Table | pa.RecordBatchReader, batch_id: str = None) -> list[FileMarker]:
+        """
+        Like `insert`, but takes an Arrow table (or a reader of record batches, which is read in full) instead of
+        rows of dicts, so the rows never become Python objects.
+
+        Rows are partitioned by a `_partition` string column if present, which is dropped unless `preserve_partition`
+        is set. Rows without one (or with a null `_partition`) are passed to the partition function as dicts, or if
+        the partition function is a SQL expression, it is evaluated over the whole table at once.
+        Partitions are split with vectorized Arrow compute, and each is written from a zero-copy slice of the table.
+
+        A `batch_id` makes the insert idempotent, like with `insert`.
+        """
+        if batch_id is not None:
+            committed = self.__get_committed_batch(batch_id)
+            if committed is not None:
+                return committed
+        table = data.read_all() if isinstance(data, pa.RecordBatchReader) else data
+        return self.__insert_parts(self.__partition_table(table), batch_id)
+
+    def insert_stream(self, data: Iterable[dict | pa.RecordBatch | pa.Table], max_partition_rows: int = 1_000_000,
+                      max_partition_bytes: int = 128 * 1024 * 1024, max_buffer_bytes: int = 512 * 1024 * 1024,
+                      chunk_rows: int = 10_000) -> list[FileMarker]:
         """
+        Inserts an iterable of rows (dicts), Arrow record batches, or Arrow tables (they can be mixed) without holding
+        all of it in memory, committing a single log file with every data file at the end.
+
+        Rows are partitioned `chunk_rows` at a time (batches and tables as they come) into per-partition buffers. A
+        partition's buffer is written as a data file once it reaches `max_partition_rows` rows or
+        `max_partition_bytes` (in memory), and the largest buffer is written whenever all of them together reach
+        `max_buffer_bytes`. Up to `max_threads` files are written at a time, and the rest of the buffers are written at
+        the end. A partition may therefore get more than one data file per stream.
+
+        If the stream fails part way, no log file is written, so none of the data is visible.
+        """
+        running_schema = Schema()
+        file_markers: list[FileMarker] = []
+        buffers: Dict[str, list[pa.Table]] = {}
+        buffer_rows: Dict[str, int] = {}
+        buffer_bytes: Dict[str, int] = {}
+        pending_rows: list[dict] = []
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads) as executor:
+            in_flight = set()
+
+            def collect(futures):
+                for future in futures:
+                    result: tuple[FileMarker, Schema] = future.result()
+                    file_markers.append(result[0])
+                    running_schema.accumulate(result[1].columns(), result[1].types())
+
+            def flush(part: str):
+                nonlocal in_flight
+                if len(in_flight) >= self.max_threads:
+                    # wait for a file to finish, so at most max_threads buffers are held while being written
+                    done, in_flight = concurrent.futures.wait(in_flight,
+                                                              return_when=concurrent.futures.FIRST_COMPLETED)
+                    collect(done)
+                part_table = pa.concat_tables(buffers.pop(part), promote_options="default")
+                del buffer_rows[part]
+                del buffer_bytes[part]
+                for file_table in self.__split_part(part_table):
+                    in_flight.add(executor.submit(self.__insert_part, part, file_table))
+
+            def buffer(part_map: Dict[str, pa.Table]):
+                for part, part_table in part_map.items():
+                    buffers.setdefault(part, []).append(part_table)
+                    buffer_rows[part] = buffer_rows.get(part, 0) + part_table.num_rows
+                    buffer_bytes[part] = buffer_bytes.get(part, 0) + part_table.nbytes
+                    if buffer_rows[part] >= max_partition_rows or buffer_bytes[part] >= max_partition_bytes:
+                        flush(part)
+                while len(buffer_bytes) > 0 and sum(buffer_bytes.values()) >= max_buffer_bytes:
+                    flush(max(buffer_bytes, key=buffer_bytes.get))
+
+            for item in data:
+                if isinstance(item, dict):
+                    pending_rows.append(item)
+                    if len(pending_rows) >= chunk_rows:
+                        buffer(self.__partition_rows(pending_rows, copy=True))
+                        pending_rows = []
+                    continue
+                if isinstance(item, pa.RecordBatch):
+                    item = pa.Table.from_batches([item])
+                # buffered partitions are copied, otherwise each would keep its whole batch in memory while only its
+                # own rows are counted against the limits
+                buffer(self.__partition_table(item, copy=True))
+
+            if len(pending_rows) > 0:
+                buffer(self.__partition_rows(pending_rows, copy=True))
+            for part in list(buffers.keys()):
+                flush(part)
+            collect(concurrent.futures.as_completed(in_flight))
+
+        # Append to log
+        logio = self.logio
+        logio.append(self.log_s3c, self.log_version, running_schema, file_markers)
+
+        return file_markers
+
+    def insert_files(self, paths: list[str], format: str = None, read_options: str = None) -> list[FileMarker]:
+        """
+        Inserts local CSV, newline delimited JSON, or Parquet files (read natively by DuckDB, no rows become Python
+        objects), committing a single log file with every data file. Useful for backfilling.
+
+        `format` is one of 'csv', 'json', or 'parquet', and is inferred from the extension of the first path if not
+        provided (compressed files like `.csv.gz` are supported). `read_options` are extra arguments for the DuckDB
+        reader, for example `"delim='|', header=true"`.
+
+        The partition function must be a SQL expression. The files are loaded into DuckDB once, then one file per
+        partition is written in parallel, sorted by `sort_order` (or with `custom_insert_query`, over `_rows`).
+        Partitions are split into files of at most `max_rows_per_file` rows if set (`target_file_bytes` is not used).
+        """
+        if not isinstance(self.partition_function, str):
+            raise AttributeError("insert_files requires the partition function to be a SQL expression, use "
+                                 "insert_stream to insert files with a partition function")
+        if len(paths) == 0:
+            return []
+        if format is None:
+            format = get_file_format(paths[0])
+        if format not in FILE_READERS:
+            raise AttributeError(f"invalid file format '{format}', must be one of {list(FILE_READERS.keys())}")
+
+        source = "{}([{}]{})".format(FILE_READERS[format], ', '.join(map(lambda x: sql_string(x), paths)),
+                                     '' if read_options is None else ', ' + read_options)
+        table = f"_icedb_files_{uuid4().hex}"
+        running_schema = Schema()
+        file_markers: list[FileMarker] = []
+
+        with self.duckdb_session() as ddb:
+            columns = ddb.execute(f"describe select * from {source}").arrow().column('column_name').to_pylist()
+            expression = self.partition_function
+            if "_partition" in columns:
+                expression = f"coalesce(_partition::VARCHAR, ({expression}))"
+            exclude = ["_icedb_partition"]
+            if "_partition" in columns and not self.preserve_partition:
+                exclude.append("_partition")
+
+            # the table lives in the session's database, so cursors writing partitions in parallel can all read it
+            ddb.execute(f"create table {table} as select *, ({expression})::VARCHAR as _icedb_partition from {source}")
+            try:
+                parts = ddb.execute(f"select _icedb_partition, count(*) from {table} group by all").fetchall()
+                nulls = sum(map(lambda x: x[1], filter(lambda x: x[0] is None, parts)))
+                if nulls > 0:
+                    raise AttributeError(f"partition expression returned null for {nulls} rows")
+
+                # every partition has the same columns, so the schema is described once
+                schema_arrow = ddb.execute("describe select * exclude ({}) from {}".format(', '.join(exclude),
+                                                                                          table)).arrow()
+                running_schema.accumulate(list(map(lambda x: str(x), schema_arrow.column('column_name'))),
+                                          list(map(lambda x: str(x), schema_arrow.column('column_type'))))
+
+                def write_part(part: str, file_index: int, files: int) -> FileMarker:
+                    filename = str(uuid4()) + '.parquet'
+                    path_parts = ['_data', part, filename]
+                    if self.data_s3c.s3prefix is not None:
+                        path_parts = [self.data_s3c.s3prefix] + path_parts
+                    fullpath = '/'.join(path_parts)
+
+                    cursor = ddb.cursor()
+                    try:
+                        # temp views are per connection, so each cursor gets its own `_rows`
+                        cursor.execute("create temp view _rows as select * exclude ({}) from {} where "
+                                       "_icedb_partition = {}{}".format(', '.join(exclude), table, sql_string(part),
+                                                                        '' if files == 1 else
+                                                                        f" and rowid % {files} = {file_index}"))
+                        file_bytes = self.__write_parquet(cursor, 'select * from _rows order by {}'.format(
+                            ','.join(self.sort_order)) if self.custom_insert_query is None
+                                                          else self.custom_insert_query, fullpath)
+                    finally:
+                        cursor.close()
+                    return FileMarker(fullpath, round(time() * 1000), file_bytes)
+
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads) as executor:
+                    futures = []
+                    for part, rows in parts:
+                        # only the row count of a partition is known up front, so target_file_bytes is not used
+                        files = 1 if self.max_rows_per_file is None else -(-rows // self.max_rows_per_file)
+                        for file_index in range(files):
+                            futures.append(executor.submit(write_part, part, file_index, files))
+
+                    for future in concurrent.futures.as_completed(futures):
+                        file_markers.append(future.result())
+            finally:
+                ddb.execute(f"drop table {table}")
+
+        # Append to log
+        logio = self.logio
+        logio.append(self.log_s3c, self.log_version, running_schema, file_markers)
+
+        return file_markers
+
+    def __partition_rows(self, rows: list[dict], copy: bool = False) -> Dict[str, pa.Table]:
+        """
+        Groups rows by partition, returning a table for each partition. See `__partition_table` for `copy`.
+        """
+        if isinstance(self.partition_function, str):
+            # partition expressions run over whole columns
+            return self.__partition_table(rows_to_table(rows), copy)
+
         part_map: Dict[str, list[dict]] = {}
         for row in rows:
             part: str
@@ -199,13 +694,100 @@ class IceDBv3:
                 part_map[part] = []
             part_map[part].append(row)
 
+        return {part: rows_to_table(part_ref) for part, part_ref in part_map.items()}
+
+    def __partition_table(self, table: pa.Table, copy: bool = False) -> Dict[str, pa.Table]:
+        """
+        Groups the rows of a table by partition with vectorized Arrow compute, returning a zero-copy slice for each
+        partition. See `insert_arrow`.
+
+        With `copy`, each partition is taken into its own table instead, so holding one partition does not keep the
+        memory of the whole table alive.
+        """
+        if table.num_rows == 0:
+            return {}
+
+        if isinstance(self.partition_function, str):
+            parts = self.__evaluate_partition_expression(table)
+            if parts.null_count > 0:
+                raise AttributeError(f"partition expression returned null for {parts.null_count} rows")
+        elif "_partition" in table.column_names:
+            parts = table.column("_partition").cast(pa.string()).combine_chunks()
+        else:
+            parts = pa.nulls(table.num_rows, pa.string())
+
+        if "_partition" in table.column_names and not self.preserve_partition:
+            table = table.drop_columns(["_partition"])
+
+        if parts.null_count > 0:
+            # fall back to the partition function for the rows without a partition
+            missing = pc.indices_nonzero(pc.is_null(parts))
+            computed = list(map(self.partition_function, table.take(missing).to_pylist()))
+            parts = pc.replace_with_mask(parts, pc.is_null(parts), pa.array(computed, pa.string()))
+
+        # sort by partition so each one is a contiguous slice, then find where the partition changes
+        order = pc.sort_indices(parts)
+        if not copy:
+            table = table.take(order)
+        parts = parts.take(order)
+        changes = pc.indices_nonzero(pc.not_equal(parts.slice(1), parts.slice(0, len(parts) - 1)))
+        boundaries = [0] + list(map(lambda x: x + 1, changes.to_pylist())) + [len(parts)]
+
+        part_map: Dict[str, pa.Table] = {}
+        for start, end in zip(boundaries[:-1], boundaries[1:]):
+            if copy:
+                part_map[parts[start].as_py()] = table.take(order.slice(start, end - start))
+            else:
+                part_map[parts[start].as_py()] = table.slice(start, end - start)
+        return part_map
+
+    def __evaluate_partition_expression(self, _rows: pa.Table) -> pa.Array:
+        """
+        Evaluates the partition expression over the table with DuckDB, with `_partition` taking precedence over it
+        when the column exists
+        """
+        expression = self.partition_function
+        if "_partition" in _rows.column_names:
+            expression = f"coalesce(_partition::VARCHAR, ({expression}))"
+        with self.duckdb_session() as ddb:
+            ddb.register("_rows", _rows)
+            try:
+                result = ddb.execute(f"select ({expression})::VARCHAR from _rows").arrow()
+            finally:
+                ddb.unregister("_rows")
+        return result.column(0).cast(pa.string()).combine_chunks()
+
+    def __split_part(self, part_table: pa.Table) -> list[pa.Table]:
+        """
+        Splits a partition's rows into evenly sized zero-copy slices of at most `max_rows_per_file` rows and about
+        `target_file_bytes` (of Arrow memory, the parquet files are typically smaller), one per data file
+        """
+        files = 1
+        if self.max_rows_per_file is not None:
+            files = max(files, -(-part_table.num_rows // self.max_rows_per_file))
+        if self.target_file_bytes is not None:
+            files = max(files, -(-part_table.nbytes // self.target_file_bytes))
+        files = min(files, max(part_table.num_rows, 1))
+        if files == 1:
+            return [part_table]
+
+        rows_per_file = -(-part_table.num_rows // files)
+        return list(map(lambda x: part_table.slice(x, rows_per_file), range(0, part_table.num_rows, rows_per_file)))
+
+    def __insert_parts(self, part_map: Dict[str, pa.Table], batch_id: str = None) -> list[FileMarker]:
+        """
+        Writes a file for each partition in parallel, then appends a single log file with all of them. With a
+        `batch_id`, file names are derived from it, and the commit is tracked with a batch marker.
+        """
         running_schema = Schema()
         file_markers: list[FileMarker] = []
 
         with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads) as executor:
             futures = []
             for part, part_ref in part_map.items():
-                futures.append(executor.submit(self.__insert_part, part, part_ref))
+                for i, file_table in enumerate(self.__split_part(part_ref)):
+                    file_id = None if batch_id is None else str(uuid5(NAMESPACE_URL, f"{batch_id}/{part}/{i}"))
+                    futures.append(executor.submit(self.__insert_part, part, file_table, file_id))
 
             for futures in concurrent.futures.as_completed(futures):
                 result: tuple[FileMarker, Schema] = futures.result()
@@ -214,115 +796,304 @@ class IceDBv3:
                 # accumulate schema
                 running_schema.accumulate(result[1].columns(), result[1].types())
 
-        # Append to log
-        logio = IceLogIO(self.path_safe_hostname)
-        logio.append(self.log_s3c, 1, running_schema, file_markers)
+        if batch_id is None:
+            # Append to log
+            logio = self.logio
+            logio.append(self.log_s3c, self.log_version, running_schema, file_markers)
+            return file_markers
+
+        # the marker records the log file key before appending, so a retry (from any host) can tell if the append
+        # went through
+        logio = self.logio
+        timestamp = round(time() * 1000)
+        log_key = logio.log_file_key(self.log_s3c, self.log_version, timestamp)
+        self.__put_batch(batch_id, timestamp, file_markers, log_key)
+        logio.append(self.log_s3c, self.log_version, running_schema, file_markers, timestamp=timestamp,
+                     batch_id=batch_id)
+        self.__put_batch(batch_id, timestamp, file_markers, log_key, committed=True)
 
         return file_markers
 
-    def merge(self, max_file_size=10_000_000, max_file_count=10, asc=False) -> tuple[
+    def __batch_key(self, batch_id: str) -> str:
+        return '/'.join([self.log_s3c.s3prefix, '_batch', batch_id + '.json'])
+
+    def __put_batch(self, batch_id: str, timestamp: int, file_markers: list[FileMarker], log_key: str,
+                    committed: bool = False):
+        """
+        Writes the marker of an idempotent insert, with the key of the log file that commits it
+        """
+        d = {
+            "id": batch_id,
+            "t": timestamp,
+            "log": log_key,
+            "f": list(map(lambda x: json.loads(x.json()), file_markers))
+        }
+        if committed:
+            d["c"] = True
+        self.log_s3c.s3.put_object(
+            Body=bytes(json.dumps(d), 'utf-8'),
+            Bucket=self.log_s3c.s3bucket,
+            Key=self.__batch_key(batch_id)
+        )
+
+    def __expire_batches(self, expired: int):
+        """
+        Deletes the batch markers last written at or before the expired time
+        """
+        prefix = '/'.join([self.log_s3c.s3prefix, '_batch']) + '/'
+        continuation_token = None
+        while True:
+            params = {"Bucket": self.log_s3c.s3bucket, "Prefix": prefix}
+            if continuation_token is not None:
+                params["ContinuationToken"] = continuation_token
+            res = self.log_s3c.s3.list_objects_v2(**params)
+            for obj in res.get('Contents', []):
+                if obj['LastModified'].timestamp() * 1000 <= expired:
+                    self.log_s3c.s3.delete_object(Bucket=self.log_s3c.s3bucket, Key=obj['Key'])
+            if not res['IsTruncated']:
+                return
+            continuation_token = res['NextContinuationToken']
+
+    def __get_committed_batch(self, batch_id: str) -> list[FileMarker] | None:
+        """
+        Returns the file markers of the batch if it was already committed, otherwise None
+        """
+        try:
+            obj = self.log_s3c.s3.get_object(Bucket=self.log_s3c.s3bucket, Key=self.__batch_key(batch_id))
+        except self.log_s3c.s3.exceptions.NoSuchKey:
+            return None
+        batch = json.loads(obj['Body'].read())
+        file_markers = list(map(lambda x: FileMarkerFromJSON(x), batch["f"]))
+        if batch.get("c", False):
+            return file_markers
+
+        # the append may have succeeded without the marker being updated
+        try:
+            self.log_s3c.s3.head_object(Bucket=self.log_s3c.s3bucket, Key=batch["log"])
+        except self.log_s3c.s3.exceptions.ClientError as e:
+            if e.response['Error']['Code'] == "404":
+                return None
+            raise e
+        self.__put_batch(batch_id, batch["t"], file_markers, batch["log"], committed=True)
+        return file_markers
+
+    def merge(self, max_file_size=10_000_000, max_file_count=10, asc=False,
+              strategy: CompactionStrategy = None) -> tuple[
         str | None, FileMarker | None, str | None, list[FileMarker] | None, LogMetadata | None]:
         """
         desc merge should be done often, working on recent partitions. asc merge should be done less often,
          fully optimizing partitions over time.
 
+        The files to merge are picked by the `strategy` if provided (see compaction.py), otherwise by a
+        `DefaultCompaction` with `max_file_size`, `max_file_count`, and `asc` (which are ignored when a strategy is
+        provided). Only the first merge plan is run.
+
         Returns new_log, new_file_marker, partition, merged_file_markers, meta
         """
-        logio = IceLogIO(self.path_safe_hostname)
+        logio = self.logio
         cur_schema, cur_files, cur_tombstones, all_log_files = logio.read_at_max_time(self.log_s3c, round(time() * 1000))
 
-        # Group by partition
-        partitions: Dict[str, list[FileMarker]] = {}
-        for file in cur_files:
-            partition = self.__get_file_partition(file.path)
-            if partition not in partitions:
-                partitions[partition] = []
-            partitions[partition].append(file)
+        if strategy is None:
+            strategy = DefaultCompaction(max_file_size, max_file_count, asc)
+        plans = strategy.plan(cur_files.group_by_partition(), 1)[:1]
+        if len(plans) == 0:
+            # otherwise we did not merge
+            return None, None, None, [], None
 
-        # sort the dict
-        partitions = dict(sorted(partitions.items(), key=lambda item: len(item[1]), reverse=not asc))
-        for partition, file_markers in partitions.items():
-            if len(file_markers) <= 1:
-                continue
-            # sort the items in the array by file size, asc
-            sorted_file_markers = sorted(file_markers, key=lambda item: item.fileBytes)
-            # aggregate until we meet the max file count or limit
-            acc_bytes = 0
-            acc_file_markers: list[FileMarker] = []
-            for file_marker in sorted_file_markers:
-                if file_marker.tombstone is not None:
-                    continue
-                acc_bytes += file_marker.fileBytes
-                acc_file_markers.append(file_marker)
-                if acc_bytes >= max_file_size or len(acc_file_markers) > 1 and len(acc_file_markers) >= max_file_count:
-                    # then we merge
-                    break
-            if len(acc_file_markers) == 1:
-                # this partition had nothing to merge
-                continue
+        new_log, meta = self.__run_merges(plans, 1, cur_files)
+        return new_log, plans[0].new_file_marker, plans[0].partition, plans[0].file_markers, meta
 
-            # merge data parts
-            filename = str(uuid4()) + '.parquet'
-            path_parts = ['_data', partition, filename]
-            if self.data_s3c.s3prefix is not None:
-                path_parts = [self.data_s3c.s3prefix] + path_parts
-            fullpath = '/'.join(path_parts)
+    def merge_many(self, max_file_size=10_000_000, max_file_count=10, asc=False, max_partitions: int = None,
+                   concurrency: int = None, strategy: CompactionStrategy = None) -> tuple[
+        str | None, list[MergePlan], LogMetadata | None]:
+        """
+        Like calling `merge` until nothing is merged, but from a single read of the log: plans merges for up to
+        `max_partitions` partitions (all of them if None, in the same order as `merge`), runs up to `concurrency`
+        (default `max_threads`) of them at a time, and commits all of them in a single merged log file. Strategies
+        may plan several merges in the same partition.
 
-            q = "COPY ({}) TO '{}' (FORMAT PARQUET, CODEC '{}', ROW_GROUP_SIZE {})".format(
-                ("select * from source_files" if self.custom_merge_query is None else self.custom_merge_query).replace(
-                    "source_files", "read_parquet(?, hive_partitioning=1)"),
-                's3://{}/{}'.format(self.data_s3c.s3bucket, fullpath),
-                self.compression_codec.value, self.row_group_size
-            )
+        Returns new_log, the executed merge plans (with their new_file_marker), and meta. new_log is None if nothing
+        was merged.
+        """
+        logio = self.logio
+        cur_schema, cur_files, cur_tombstones, all_log_files = logio.read_at_max_time(self.log_s3c, round(time() * 1000))
+
+        if strategy is None:
+            strategy = DefaultCompaction(max_file_size, max_file_count, asc)
+        plans = strategy.plan(cur_files.group_by_partition(), max_partitions)
+        if len(plans) == 0:
+            return None, [], None
+
+        new_log, meta = self.__run_merges(plans, concurrency if concurrency is not None else self.max_threads,
+                                          cur_files)
+        return new_log, plans, meta
+
+    def plan_merge(self, max_file_size=10_000_000, max_file_count=10, asc=False, max_partitions: int = None,
+                   strategy: CompactionStrategy = None, file_markers: FileMarkerSet = None) -> list[MergePlan]:
+        """
+        Dry run of `merge_many` with the same arguments: returns the merge plans it would run without merging
+        anything. Each plan has the files it would merge, and estimates of the bytes read and written, the reduction in
+        the partition's file count, and the fraction of the partition's files removed (`read_reduction`).
+
+        Plans from the current state of the log, or from `file_markers` (e.g. from `read_at_max_time`) without
+        reading the log. No data files are read.
+        """
+        if file_markers is None:
+            logio = self.logio
+            _, file_markers, _, _ = logio.read_at_max_time(self.log_s3c, round(time() * 1000))
+        elif not isinstance(file_markers, FileMarkerSet):
+            file_markers = FileMarkerSet(file_markers)
+
+        if strategy is None:
+            strategy = DefaultCompaction(max_file_size, max_file_count, asc)
+        return strategy.plan(file_markers.group_by_partition(), max_partitions)
+
+    def __merge_files(self, plan: MergePlan) -> tuple[str, int]:
+        """
+        Writes the merged data file of a plan, returning its path and size
+        """
+        filename = str(uuid4()) + '.parquet'
+        path_parts = ['_data', plan.partition, filename]
+        if self.data_s3c.s3prefix is not None:
+            path_parts = [self.data_s3c.s3prefix] + path_parts
+        fullpath = '/'.join(path_parts)
+
+        if self.custom_merge_query is None and self.merge_mode in (MergeMode.SORTED, MergeMode.PASSTHROUGH):
+            merged_file_size = self.__merge_local(plan, fullpath)
+            if merged_file_size is not None:
+                return fullpath, merged_file_size
 
-            ddb = self.get_duckdb()
-            ddb.execute(q, [
-                list(map(lambda x: f"s3://{self.data_s3c.s3bucket}/{x.path}", acc_file_markers))
+        q = ("select * from source_files" if self.custom_merge_query is None else self.custom_merge_query).replace(
+            "source_files", "read_parquet(?, hive_partitioning=1)")
+
+        with self.duckdb_session() as ddb:
+            merged_file_size = self.__write_parquet(ddb, q, fullpath, [
+                list(map(lambda x: f"s3://{self.data_s3c.s3bucket}/{x.path}", plan.file_markers))
             ])
+        return fullpath, merged_file_size
 
-            # get the new file size
-            obj = self.data_s3c.s3.head_object(
-                Bucket=self.data_s3c.s3bucket,
-                Key=fullpath
-            )
-            merged_file_size = obj['ContentLength']
-
-            # Now we need to get the current state of the files we just merged, and write that plus the new state
-            # We can keep the current schema
-            merged_log_files = list(map(lambda x: x.vir_source_log_file, acc_file_markers))
-            m_schema, m_file_markers, m_tombstones = logio.read_log_forward(self.log_s3c, merged_log_files)
-
-            # create new log file with tombstones
-            acc_file_paths = list(map(lambda x: x.path, acc_file_markers))
-            merged_time = round(time() * 1000)
-            new_file_marker = FileMarker(fullpath, merged_time, merged_file_size)
-
-            updated_markers = list(map(lambda x: FileMarker(
-                x.path,
-                x.createdMS,
-                x.fileBytes,
-                merged_time if x.path in acc_file_paths else x.tombstone),
-                                       m_file_markers))
-
-
-            new_tombstones = list(map(lambda x: LogTombstone(x, merged_time),
-                                      merged_log_files))
-
-            new_log, meta = logio.append(
-                self.log_s3c,
-                1,
-                m_schema,
-                updated_markers + [
-                    new_file_marker
-                ],
-                m_tombstones + new_tombstones,
-                merged=True
-            )
+    def __merge_local(self, plan: MergePlan, fullpath: str) -> int | None:
+        """
+        Downloads the files of the plan to local temporary files and merges them without DuckDB, uploading the merged
+        file and returning its size. With `MergeMode.PASSTHROUGH` the row groups are concatenated as they are if the
+        files allow it, otherwise (and with `MergeMode.SORTED`) they are merged with `__merge_sorted`.
 
-            return new_log, new_file_marker, partition, acc_file_markers, meta
+        Returns None without writing anything if neither applies, in which case the merge is done by DuckDB.
+        """
+        tmp_dir = tempfile.mkdtemp(dir=self.upload_tmp_dir)
+        try:
+            local_paths = []
+            for i, fm in enumerate(plan.file_markers):
+                local_path = os.path.join(tmp_dir, f"{i}.parquet")
+                self.data_s3c.s3.download_file(self.data_s3c.s3bucket, fm.path, local_path, Config=self.upload_config)
+                local_paths.append(local_path)
+
+            merged_path = os.path.join(tmp_dir, "merged.parquet")
+            merged = False
+            if self.merge_mode == MergeMode.PASSTHROUGH:
+                merged = concat_files(local_paths, merged_path, PARQUET_CODECS[self.compression_codec.value],
+                                      round(self.row_group_size * PASSTHROUGH_MIN_ROW_GROUP_FILL))
+                if merged:
+                    # make sure the rewritten footer can be read before uploading it
+                    pq.ParquetFile(merged_path).metadata
+            if not merged:
+                merged = self.__merge_sorted(local_paths, merged_path)
+            if not merged:
+                return None
+
+            self.data_s3c.s3.upload_file(merged_path, self.data_s3c.s3bucket, fullpath, Config=self.upload_config)
+            return os.path.getsize(merged_path)
+        finally:
+            for name in os.listdir(tmp_dir):
+                os.remove(os.path.join(tmp_dir, name))
+            os.rmdir(tmp_dir)
+
+    def __merge_sorted(self, local_paths: list[str], merged_path: str) -> bool:
+        """
+        Merges the parquet files with a streaming k-way merge on the sort order, reading a row group size batch of each
+        file at a time. The merged file has the union of the files' columns (hive partition columns are not added).
+
+        Returns False without writing anything if the sort order is not made of plain column names of the files, or
+        the files have conflicting column types.
+        """
+        files = list(map(lambda x: pq.ParquetFile(x), local_paths))
+        try:
+            schema = pa.unify_schemas(list(map(lambda x: x.schema_arrow.remove_metadata(), files)))
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            return False
+        sort_keys = list(map(lambda x: get_sort_column(x, schema.names), self.sort_order))
+        if None in sort_keys:
+            return False
+
+        def read(f: pq.ParquetFile) -> Iterator[pa.Table]:
+            for batch in f.iter_batches(batch_size=self.row_group_size):
+                yield conform_table(pa.Table.from_batches([batch]), schema)
+
+        with pq.ParquetWriter(merged_path, schema, compression=self.compression_codec.value.lower()
+                              if self.compression_codec != CompressionCodec.UNCOMPRESSED else "none") as writer:
+            # buffer the merged rows so row groups are row_group_size rows
+            buffered: list[pa.Table] = []
+            buffered_rows = 0
+            for table in merge_sorted(list(map(read, files)), sort_keys):
+                buffered.append(table)
+                buffered_rows += table.num_rows
+                if buffered_rows >= self.row_group_size:
+                    out = pa.concat_tables(buffered)
+                    full = out.num_rows - out.num_rows % self.row_group_size
+                    writer.write_table(out.slice(0, full), row_group_size=self.row_group_size)
+                    buffered = [out.slice(full)]
+                    buffered_rows = out.num_rows - full
+            if buffered_rows > 0:
+                writer.write_table(pa.concat_tables(buffered), row_group_size=self.row_group_size)
+        return True
+
+    def __run_merges(self, plans: list[MergePlan], concurrency: int, cur_files: FileMarkerSet) -> tuple[
+        str, LogMetadata]:
+        """
+        Writes the merged files of the plans in parallel, then commits all of them in a single merged log file.
+        `cur_files` is the current state the plans were made from.
+        """
+        logio = self.logio
+        if concurrency <= 1 or len(plans) == 1:
+            merged_files = list(map(self.__merge_files, plans))
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+                merged_files = list(executor.map(self.__merge_files, plans))
+
+        # Now we need to get the current state of the files we just merged, and write that plus the new state
+        # We can keep the current schema
+        merged_log_files = list(dict.fromkeys(map(lambda x: x.vir_source_log_file,
+                                                  [fm for plan in plans for fm in plan.file_markers])))
+        m_schema, m_file_markers, m_tombstones = logio.read_log_forward(self.log_s3c, merged_log_files)
+        # restate the markers with their current state, not the one they were written with, otherwise files removed
+        # or merged since those log files were written would come back
+        m_file_markers = list(map(lambda x: cur_files.get(x.path) or x, m_file_markers))
+
+        # create new log file with tombstones
+        acc_file_paths = set(map(lambda x: x.path, [fm for plan in plans for fm in plan.file_markers]))
+        merged_time = round(time() * 1000)
+        for plan, (fullpath, merged_file_size) in zip(plans, merged_files):
+            plan.new_file_marker = FileMarker(fullpath, merged_time if plan.created_ms is None else plan.created_ms,
+                                              merged_file_size)
 
-        # otherwise we did not merge
-        return None, None, None, [], None
+        updated_markers = list(map(lambda x: FileMarker(
+            x.path,
+            x.createdMS,
+            x.fileBytes,
+            merged_time if x.path in acc_file_paths else x.tombstone),
+                                   m_file_markers))
+
+        new_tombstones = list(map(lambda x: LogTombstone(x, merged_time),
+                                  merged_log_files))
+
+        return logio.append(
+            self.log_s3c,
+            self.log_version,
+            m_schema,
+            updated_markers + list(map(lambda x: x.new_file_marker, plans)),
+            m_tombstones + new_tombstones,
+            merged=True
+        )
 
     def tombstone_cleanup(self, min_age_ms: int) -> tuple[list[str], list[str], list[str]]:
         """
@@ -330,10 +1101,15 @@ class IceDBv3:
 
         For performance, icedb will optimistically delete files from S3, meaning that if a crash occurs during the middle of a removal then files may be left in S3 even though they are seen as deleted in the DB.
 
+        Batch markers of idempotent inserts (see `insert`) older than `min_age_ms` are deleted as well, so batches can
+        only be safely retried within that time.
+
         Returns the list of log files that were cleaned, log files that were deleted, and data files that
         were deleted
         """
-        logio = IceLogIO(self.path_safe_hostname)
+        # Always read the full log without the snapshot cache or checkpoints, as they may still reference log
+        # files that a previous cleanup deleted
+        logio = IceLogIO(self.path_safe_hostname, self.log_read_concurrency, compression=self.log_compression)
         cleaned_log_files: list[str] = []
         deleted_log_files: list[str] = []
         deleted_data_files: list[str] = []
@@ -350,35 +1126,23 @@ class IceDBv3:
         # We only need to get merge files
         merge_log_files = list(filter(lambda x: get_log_file_info(x)[1], all_log_files))
         
-        for log_file in merge_log_files:
-            obj = self.log_s3c.s3.get_object(
-                Bucket=self.log_s3c.s3bucket,
-                Key=log_file
-            )
-            jsonl = str(obj['Body'].read(), encoding="utf-8").split("\n")
-            meta_json = json.loads(jsonl[0])
-            meta = LogMetadataFromJSON(meta_json)
-            expired = now - min_age_ms  # time at which a tombstone is allowed to be deleted
+        expired = now - min_age_ms  # time at which a tombstone is allowed to be deleted
+        for log_file, (meta, schema_json, log_tombstones, file_markers) in zip(
+                merge_log_files, logio.read_log_files(self.log_s3c, merge_log_files)):
             # Log tombstones
-            if meta.tombstoneLineIndex is not None:
-                for i in range(meta.tombstoneLineIndex, meta.fileLineIndex):
-                    tmb = LogTombstoneFromJSON(dict(json.loads(jsonl[i])))
-                    if tmb.createdMS <= expired:
-                        log_files_to_delete[tmb.path] = True
-                    else:
-                        log_files_to_keep[tmb.path] = tmb
+            for tmb in log_tombstones:
+                if tmb.createdMS <= expired:
+                    log_files_to_delete[tmb.path] = True
+                else:
+                    log_files_to_keep[tmb.path] = tmb
             # File markers
-            for i in range(meta.fileLineIndex, len(jsonl)):
-                fm_json = dict(json.loads(jsonl[i]))
-                fm = FileMarkerFromJSON(fm_json)
-
+            for fm in file_markers:
                 tombstone = fm.tombstone
                 if not tombstone:
                     # find fm.path in cur_files
-                    for cf in cur_files:
-                        if cf.path == fm.path:
-                            tombstone = cf.tombstone
-                            break
+                    cf = cur_files.get(fm.path)
+                    if cf is not None:
+                        tombstone = cf.tombstone
                 if tombstone is not None and tombstone <= expired:
                     data_files_to_delete[fm.path] = True
                     if fm.path in data_files_to_keep:
@@ -387,7 +1151,6 @@ class IceDBv3:
                     data_files_to_keep[fm.path] = fm
 
             # Accumulate schema
-            schema_json = dict(json.loads(jsonl[meta.schemaLineIndex]))
             schema.accumulate(list(schema_json.keys()), list(schema_json.values()))
 
             cleaned_log_files.append(log_file)
@@ -413,7 +1176,7 @@ class IceDBv3:
         # New log file
         new_log, _ = logio.append(
             self.log_s3c,
-            1,
+            self.log_version,
             schema,
             list(data_files_to_keep.values()),
             list(log_files_to_keep.values()),  # kept because we must preserve tombstones for `min_age`
@@ -428,10 +1191,24 @@ class IceDBv3:
                 Bucket=self.log_s3c.s3bucket,
                 Key=path
             )
+        # Checkpoints cover the log files we just rewrote and deleted, so they must be taken again
+        self.logio.delete_checkpoints(self.log_s3c)
+        self.__expire_batches(expired)
         print(f"Keeping {len(data_files_to_keep)} files")
 
         return cleaned_log_files, deleted_log_files, deleted_data_files
 
+    def checkpoint(self, lag_ms: int = 60_000) -> tuple[str | None, int | None]:
+        """
+        Collapses the state of the log files older than `lag_ms` into a single checkpoint file, so readers using
+        checkpoints only need to replay the log files created after it. See `IceLogIO.checkpoint`.
+
+        Tombstone cleanup deletes existing checkpoints, so this should be run again after it.
+
+        Returns the checkpoint path and the timestamp it covers up to.
+        """
+        return self.logio.checkpoint(self.log_s3c, lag_ms)
+
     def remove_partitions(self, removal_func: PartitionRemovalFunctionType, max_files=1000) -> tuple[str | None,
     LogMetadata | None, int]:
         """
@@ -447,17 +1224,11 @@ class IceDBv3:
 
         remove_time = round(time() * 1000)
 
-        logio = IceLogIO(self.path_safe_hostname)
+        logio = self.logio
         cur_schema, cur_files, cur_tombstones, all_log_files = logio.read_at_max_time(self.log_s3c, remove_time)
 
         # Group by partition (on alive files
-        alive_files = list(filter(lambda x: x.tombstone is None, cur_files))
-        partitions: Dict[str, list[FileMarker]] = {}
-        for file in alive_files:
-            partition = self.__get_file_partition(file.path)
-            if partition not in partitions:
-                partitions[partition] = []
-            partitions[partition].append(file)
+        partitions: Dict[str, FileMarkerSet] = cur_files.alive().group_by_partition()
 
         partitions_to_remove = removal_func(list(partitions.keys()))
         if len(partitions_to_remove) == 0:
@@ -491,7 +1262,7 @@ class IceDBv3:
         log_tombstones = list(map(lambda x: LogTombstone(x, remove_time), list(modified_log_files)))
         new_log, meta = logio.append(
             self.log_s3c,
-            1,
+            self.log_version,
             cur_schema,
             updated_file_markers,
             log_tombstones,
@@ -523,16 +1294,12 @@ class IceDBv3:
 
         run_time = round(time() * 1000)
 
-        logio = IceLogIO(self.path_safe_hostname)
+        logio = self.logio
+        # the whole state is read, since the log files being tombstoned are restated from it below
         cur_schema, cur_files, cur_tombstones, all_log_files = logio.read_at_max_time(self.log_s3c, run_time)
 
         # Get alive files matching partition
-        alive_files = list(filter(lambda x: x.tombstone is None, cur_files))
-        rewrite_targets: list[FileMarker] = []
-        for file in alive_files:
-            partition = self.__get_file_partition(file.path)
-            if target_partition == partition:
-                rewrite_targets.append(file)
+        rewrite_targets = cur_files.in_partitions(lambda x: x == target_partition).alive()
 
         if len(rewrite_targets) == 0:
             return None, None, []
@@ -540,49 +1307,42 @@ class IceDBv3:
         new_files: list[FileMarker] = []
         for old_file in rewrite_targets:
             filename = str(uuid4()) + '.parquet'
-            partition = self.__get_file_partition(old_file.path)
+            partition = get_file_partition(old_file.path)
             path_parts = ['_data', partition, filename]
             if self.data_s3c.s3prefix is not None:
                 path_parts = [self.data_s3c.s3prefix] + path_parts
             fullpath = '/'.join(path_parts)
 
             # Copy the files through the query
-            ddb = self.get_duckdb()
-            ddb.execute("""
-                        copy ({}) to 's3://{}/{}' (format parquet, codec '{}', row_group_size {})
-                        """.format(
-                filter_query.replace("_rows", "read_parquet(?)"),
-                self.data_s3c.s3bucket,
-                fullpath,
-                self.compression_codec.value,
-                self.row_group_size
-            ), [f"s3://{self.data_s3c.s3bucket}/{old_file.path}"])
+            with self.duckdb_session() as ddb:
+                file_bytes = self.__write_parquet(ddb, filter_query.replace("_rows", "read_parquet(?)"), fullpath,
+                                                  [f"s3://{self.data_s3c.s3bucket}/{old_file.path}"])
             write_time = round(time() * 1000)
+            new_files.append(FileMarker(fullpath, write_time, file_bytes))
 
-            # get file metadata
-            obj = self.data_s3c.s3.head_object(
-                Bucket=self.data_s3c.s3bucket,
-                Key=fullpath
-            )
-            new_files.append(FileMarker(fullpath, write_time, obj['ContentLength']))
+        # Like a merge, restate the markers of the log files being tombstoned rather than the whole table. Their
+        # state must come from the current state of the table, not from those log files, otherwise files removed or
+        # merged since they were written would come back.
+        rewritten_log_files = list(set(map(lambda x: x.vir_source_log_file, rewrite_targets)))
+        m_schema, m_file_markers, m_tombstones = logio.read_log_forward(self.log_s3c, rewritten_log_files)
+        m_file_markers = list(map(lambda x: cur_files.get(x.path) or x, m_file_markers))
 
-        rewritten_paths = list(map(lambda x: x.path, rewrite_targets))
+        rewritten_paths = set(map(lambda x: x.path, rewrite_targets))
         updated_markers = list(map(lambda x: FileMarker(
             x.path,
             x.createdMS,
             x.fileBytes,
             run_time if x.path in rewritten_paths else x.tombstone),
-                                   cur_files))
+                                   m_file_markers))
 
-        new_tombstones = list(map(lambda x: LogTombstone(x, run_time),
-                                  list(map(lambda x: x.vir_source_log_file, rewrite_targets))))
+        new_tombstones = list(map(lambda x: LogTombstone(x, run_time), rewritten_log_files))
 
         new_log, meta = logio.append(
             self.log_s3c,
-            1,
+            self.log_version,
             cur_schema,
             updated_markers + new_files,
-            cur_tombstones + new_tombstones,
+            m_tombstones + new_tombstones,
             merged=True
         )
 
@@ -1,8 +1,35 @@
 import json
+import os
+import threading
 import boto3
 import botocore
-from typing import Dict
+import pyarrow as pa
+import pyarrow.compute as pc
+from array import array
+from typing import Dict, Callable, Iterable
 from time import time
+import concurrent.futures
+import bisect
+import itertools
+from collections import deque
+
+
+LOG_VERSION_JSONL = 1
+LOG_VERSION_ARROW = 2
+
+ARROW_LOG_SUFFIX = '.arrow'
+ARROW_LOG_BATCH_ROWS = 65_536  # Arrow log files are written in record batches of this many rows, so they can be streamed
+LOG_READ_CHUNK_BYTES = 262_144  # JSONL log files are read from S3 in chunks of this size
+LOG_COMPRESSION_SUFFIXES = {
+    "gzip": ".gz",
+    "zstd": ".zst"
+}
+ARROW_LOG_SCHEMA = pa.schema([
+    ("p", pa.string()),
+    ("b", pa.int64()),
+    ("t", pa.int64()),
+    ("tmb", pa.int64())
+])
 
 
 class SchemaConflictException(Exception):
@@ -109,6 +136,8 @@ class Schema:
 
 
 class FileMarker:
+    __slots__ = ("path", "createdMS", "fileBytes", "tombstone", "vir_source_log_file")
+
     path: str
     createdMS: int
     fileBytes: int
@@ -157,7 +186,354 @@ def FileMarkerFromJSON(jsonl: dict):
                     jsonl["tmb"] if "tmb" in jsonl else None)
     return fm
 
+
+_MISSING = -1  # FileMarkerSet stores a missing tombstone or source log file as -1
+
+
+class FileMarkerSet:
+    """
+    A compact collection of file markers for large tables, stored as columns rather than a FileMarker object per
+    file. Directory and source log file strings are interned, so each marker only holds its file name and a few
+    integers.
+
+    It behaves like a list of FileMarker: iterating and indexing create FileMarker objects on demand, so modifying
+    those does not modify the set. Adding a marker with a path that is already in the set replaces it in place, the
+    same as applying a later log file.
+
+    Sets derived from each other (filters, slices, copies) share their interned strings.
+    """
+    __slots__ = ("_dirs", "_dir_ids", "_dir_partitions", "_log_files", "_log_file_ids", "_dir", "_name", "_created",
+                 "_bytes", "_tombstone", "_log", "_index")
+
+    def __init__(self, file_markers: Iterable[FileMarker] = None):
+        self._dirs: list[str] = []
+        self._dir_ids: dict[str, int] = {}
+        self._dir_partitions: list[str] = []
+        self._log_files: list[str] = []
+        self._log_file_ids: dict[str, int] = {}
+        self.__clear()
+        if file_markers is not None:
+            self.extend(file_markers)
+
+    def __clear(self):
+        self._dir = array('q')
+        self._name: list[str] = []
+        self._created = array('q')
+        self._bytes = array('q')
+        self._tombstone = array('q')
+        self._log = array('q')
+        self._index: dict[int, dict[str, int]] | None = {}  # dir id -> file name -> row, built lazily
+
+    def __derive(self) -> 'FileMarkerSet':
+        """
+        Returns an empty set sharing the interned strings of this one
+        """
+        derived = FileMarkerSet.__new__(FileMarkerSet)
+        derived._dirs = self._dirs
+        derived._dir_ids = self._dir_ids
+        derived._dir_partitions = self._dir_partitions
+        derived._log_files = self._log_files
+        derived._log_file_ids = self._log_file_ids
+        derived.__clear()
+        return derived
+
+    def __row_index(self) -> dict[int, dict[str, int]]:
+        if self._index is None:
+            self._index = {}
+            for row, (dir_id, name) in enumerate(zip(self._dir, self._name)):
+                self._index.setdefault(dir_id, {})[name] = row
+        return self._index
+
+    def __intern_dir(self, directory: str) -> int:
+        dir_id = self._dir_ids.get(directory)
+        if dir_id is None:
+            dir_id = len(self._dirs)
+            self._dirs.append(directory)
+            self._dir_ids[directory] = dir_id
+            self._dir_partitions.append(get_file_partition(directory + "/"))
+        return dir_id
+
+    def __intern_log_file(self, log_file: str | None) -> int:
+        if log_file is None:
+            return _MISSING
+        log_id = self._log_file_ids.get(log_file)
+        if log_id is None:
+            log_id = len(self._log_files)
+            self._log_files.append(log_file)
+            self._log_file_ids[log_file] = log_id
+        return log_id
+
+    def put(self, path: str, createdMS: int, fileBytes: int, tombstone: int = None, source_log_file: str = None):
+        """
+        Adds a file marker, replacing any existing marker with the same path
+        """
+        directory, _, name = path.rpartition("/")
+        dir_id = self.__intern_dir(directory)
+        log_id = self.__intern_log_file(source_log_file)
+        tombstone = _MISSING if tombstone is None else tombstone
+        names = self.__row_index().setdefault(dir_id, {})
+        row = names.get(name)
+        if row is not None:
+            self._created[row] = createdMS
+            self._bytes[row] = fileBytes
+            self._tombstone[row] = tombstone
+            self._log[row] = log_id
+            return
+        names[name] = len(self._name)
+        self._dir.append(dir_id)
+        self._name.append(name)
+        self._created.append(createdMS)
+        self._bytes.append(fileBytes)
+        self._tombstone.append(tombstone)
+        self._log.append(log_id)
+
+    def put_columns(self, paths: pa.Array, created: pa.Array, file_bytes: pa.Array, tombstones: pa.Array,
+                    source_log_file: str = None):
+        """
+        Adds file markers from Arrow columns (with null tombstones for alive files), like calling `put` for each row.
+        When the set is empty and the paths are unique, the columns are copied in at once instead of a row at a time.
+        """
+        if len(paths) == 0:
+            return
+        if len(self) > 0 or pc.count_distinct(paths).as_py() < len(paths):
+            # rows may replace existing markers
+            for path, created_ms, size, tombstone in zip(paths.to_pylist(), created.to_pylist(),
+                                                         file_bytes.to_pylist(), tombstones.to_pylist()):
+                self.put(path, created_ms, size, tombstone, source_log_file)
+            return
+
+        directories = pc.dictionary_encode(pc.replace_substring_regex(paths, r"(^|/)[^/]*$", ""))
+        dir_ids = pa.array(list(map(self.__intern_dir, directories.dictionary.to_pylist())), pa.int64())
+        self._dir.frombytes(_int64_bytes(dir_ids.take(directories.indices)))
+        self._name.extend(pc.replace_substring_regex(paths, r"^.*/", "").to_pylist())
+        self._created.frombytes(_int64_bytes(created))
+        self._bytes.frombytes(_int64_bytes(file_bytes))
+        self._tombstone.frombytes(_int64_bytes(pc.fill_null(tombstones.cast(pa.int64()), _MISSING)))
+        self._log.extend(array('q', [self.__intern_log_file(source_log_file)]) * len(paths))
+        self._index = None
+
+    def append(self, file_marker: FileMarker):
+        self.put(file_marker.path, file_marker.createdMS, file_marker.fileBytes, file_marker.tombstone,
+                 file_marker.vir_source_log_file)
+
+    def extend(self, file_markers: Iterable[FileMarker]):
+        if isinstance(file_markers, FileMarkerSet):
+            self.__extend_set(file_markers)
+            return
+        for file_marker in file_markers:
+            self.append(file_marker)
+
+    def __extend_set(self, other: 'FileMarkerSet'):
+        """
+        Adds the markers of another set a column at a time rather than creating FileMarker objects, replacing
+        markers with the same path
+        """
+        if len(other) == 0:
+            return
+        # map the other set's interned strings to this set's
+        dir_map = pa.array(list(map(self.__intern_dir, other._dirs)), pa.int64())
+        dirs = array('q', _int64_bytes(dir_map.take(_int64_array(other._dir))))
+        logs = other._log
+        if len(other._log_files) > 0:
+            log_map = pa.array(list(map(self.__intern_log_file, other._log_files)), pa.int64())
+            log_ids = _int64_array(other._log)
+            missing = pc.equal(log_ids, _MISSING)
+            logs = array('q', _int64_bytes(pc.if_else(missing, _MISSING,
+                                                      log_map.take(pc.if_else(missing, 0, log_ids)))))
+
+        if len(self) == 0:
+            new_rows = None  # all of them
+        else:
+            index = self.__row_index()
+            new_rows = []
+            for row, (dir_id, name) in enumerate(zip(dirs, other._name)):
+                names = index.setdefault(dir_id, {})
+                existing = names.get(name)
+                if existing is None:
+                    names[name] = len(self._name) + len(new_rows)
+                    new_rows.append(row)
+                    continue
+                self._created[existing] = other._created[row]
+                self._bytes[existing] = other._bytes[row]
+                self._tombstone[existing] = other._tombstone[row]
+                self._log[existing] = logs[row]
+            if len(new_rows) == len(other):
+                new_rows = None
+
+        if new_rows is None:
+            self._dir.extend(dirs)
+            self._name.extend(other._name)
+            self._created.extend(other._created)
+            self._bytes.extend(other._bytes)
+            self._tombstone.extend(other._tombstone)
+            self._log.extend(logs)
+            if len(self) == len(other):
+                self._index = None  # rebuilt when needed
+            return
+        self._dir.extend(array('q', map(dirs.__getitem__, new_rows)))
+        self._name.extend(map(other._name.__getitem__, new_rows))
+        self._created.extend(array('q', map(other._created.__getitem__, new_rows)))
+        self._bytes.extend(array('q', map(other._bytes.__getitem__, new_rows)))
+        self._tombstone.extend(array('q', map(other._tombstone.__getitem__, new_rows)))
+        self._log.extend(array('q', map(logs.__getitem__, new_rows)))
+
+    def path(self, row: int) -> str:
+        return self._dirs[self._dir[row]] + "/" + self._name[row]
+
+    def tombstone(self, row: int) -> int | None:
+        tombstone = self._tombstone[row]
+        return None if tombstone == _MISSING else tombstone
+
+    def source_log_file(self, row: int) -> str | None:
+        log_id = self._log[row]
+        return None if log_id == _MISSING else self._log_files[log_id]
+
+    def partition(self, row: int) -> str:
+        return self._dir_partitions[self._dir[row]]
+
+    def get(self, path: str) -> FileMarker | None:
+        """
+        Returns the file marker for the path, or None if it is not in the set
+        """
+        directory, _, name = path.rpartition("/")
+        dir_id = self._dir_ids.get(directory)
+        if dir_id is None:
+            return None
+        row = self.__row_index().get(dir_id, {}).get(name)
+        return None if row is None else self[row]
+
+    def __contains__(self, item) -> bool:
+        if isinstance(item, FileMarker):
+            item = item.path
+        return self.get(item) is not None
+
+    def __len__(self) -> int:
+        return len(self._name)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self.take(range(len(self))[item])
+        if item < 0:
+            item += len(self)
+        if item < 0 or item >= len(self):
+            raise IndexError("FileMarkerSet index out of range")
+        fm = FileMarker(self.path(item), self._created[item], self._bytes[item], self.tombstone(item))
+        fm.vir_source_log_file = self.source_log_file(item)
+        return fm
+
+    def __iter__(self):
+        for row in range(len(self)):
+            yield self[row]
+
+    def __add__(self, other: Iterable[FileMarker]) -> 'FileMarkerSet':
+        combined = self.copy()
+        combined.extend(other)
+        return combined
+
+    def __radd__(self, other: Iterable[FileMarker]) -> 'FileMarkerSet':
+        combined = FileMarkerSet(other)
+        combined.extend(self)
+        return combined
+
+    def __str__(self):
+        return str(list(self))
+
+    def __repr__(self):
+        return str(self)
+
+    def copy(self) -> 'FileMarkerSet':
+        copied = FileMarkerSet.__new__(FileMarkerSet)
+        copied._dirs = list(self._dirs)
+        copied._dir_ids = dict(self._dir_ids)
+        copied._dir_partitions = list(self._dir_partitions)
+        copied._log_files = list(self._log_files)
+        copied._log_file_ids = dict(self._log_file_ids)
+        copied._dir = self._dir[:]
+        copied._name = self._name[:]
+        copied._created = self._created[:]
+        copied._bytes = self._bytes[:]
+        copied._tombstone = self._tombstone[:]
+        copied._log = self._log[:]
+        copied._index = None
+        return copied
+
+    def take(self, rows: Iterable[int] | pa.Array) -> 'FileMarkerSet':
+        """
+        Returns a new set of the markers at the given rows, in that order
+        """
+        indices = rows if isinstance(rows, pa.Array) else pa.array(list(rows), pa.int64())
+        taken = self.__derive()
+        for column in ["_dir", "_created", "_bytes", "_tombstone", "_log"]:
+            getattr(taken, column).frombytes(_int64_bytes(_int64_array(getattr(self, column)).take(indices)))
+        taken._name = list(map(self._name.__getitem__, indices.to_pylist()))
+        taken._index = None
+        return taken
+
+    def __where(self, mask: pa.Array) -> 'FileMarkerSet':
+        return self.take(pc.indices_nonzero(mask))
+
+    def paths(self) -> list[str]:
+        return list(map(self.path, range(len(self))))
+
+    def partitions(self) -> list[str]:
+        """
+        Returns the unique partitions of the markers, in the order they are first seen
+        """
+        return list(dict.fromkeys(map(self._dir_partitions.__getitem__, dict.fromkeys(self._dir))))
+
+    def alive(self) -> 'FileMarkerSet':
+        """
+        Returns the markers without a tombstone
+        """
+        return self.__where(pc.equal(_int64_array(self._tombstone), _MISSING))
+
+    def in_partitions(self, partition_filter: Callable[[str], bool]) -> 'FileMarkerSet':
+        """
+        Returns the markers whose partition the filter returns True for. The filter is called once per unique
+        directory rather than once per marker.
+        """
+        dir_ids = [dir_id for dir_id, partition in enumerate(self._dir_partitions) if partition_filter(partition)]
+        return self.__where(pc.is_in(_int64_array(self._dir), value_set=pa.array(dir_ids, pa.int64())))
+
+    def created_between(self, start_ms: int = None, end_ms: int = None) -> 'FileMarkerSet':
+        """
+        Returns the markers created at or after `start_ms`, and before `end_ms`
+        """
+        created = _int64_array(self._created)
+        mask = pa.array([True] * len(self), pa.bool_())
+        if start_ms is not None:
+            mask = pc.and_(mask, pc.greater_equal(created, start_ms))
+        if end_ms is not None:
+            mask = pc.and_(mask, pc.less(created, end_ms))
+        return self.__where(mask)
+
+    def group_by_partition(self) -> dict[str, 'FileMarkerSet']:
+        """
+        Returns the markers grouped by partition, in the order partitions are first seen
+        """
+        rows: dict[str, list[int]] = {}
+        for row, dir_id in enumerate(self._dir):
+            rows.setdefault(self._dir_partitions[dir_id], []).append(row)
+        return {partition: self.take(partition_rows) for partition, partition_rows in rows.items()}
+
+
+def _int64_bytes(values: pa.Array) -> bytes:
+    """
+    Returns the values of an Arrow integer array without nulls as native int64 bytes, for `array.frombytes`
+    """
+    values = values.cast(pa.int64())
+    return values.buffers()[1].to_pybytes()[values.offset * 8:(values.offset + len(values)) * 8]
+
+
+def _int64_array(values: array) -> pa.Array:
+    """
+    Copies an int64 array.array into an Arrow array, without exporting its buffer (which would prevent resizing it)
+    """
+    return pa.Array.from_buffers(pa.int64(), len(values), [None, pa.py_buffer(values.tobytes())])
+
 class LogTombstone:
+    __slots__ = ("path", "createdMS")
+
     path: str
     createdMS: int
 
@@ -183,19 +559,26 @@ def LogTombstoneFromJSON(jsonl: dict):
 
 
 class LogMetadata:
+    __slots__ = ("version", "schemaLineIndex", "fileLineIndex", "tombstoneLineIndex", "partitionIndexLineIndex",
+                 "timestamp", "batchID")
+
     version: int
     schemaLineIndex: int
     fileLineIndex: int
     tombstoneLineIndex: int | None
+    partitionIndexLineIndex: int | None
     timestamp: int
+    batchID: str | None
 
     def __init__(self, version: int, schemaLineIndex: int, fileLineIndex: int, tombstoneLineIndex: int = None,
-                 timestamp: int = None):
+                 timestamp: int = None, partitionIndexLineIndex: int = None, batchID: str = None):
         self.version = version
         self.schemaLineIndex = schemaLineIndex
         self.fileLineIndex = fileLineIndex
         self.tombstoneLineIndex = tombstoneLineIndex
+        self.partitionIndexLineIndex = partitionIndexLineIndex
         self.timestamp = timestamp if timestamp is not None else round(time()*1000)
+        self.batchID = batchID
 
     def toJSON(self) -> str:
         d = {
@@ -208,6 +591,12 @@ class LogMetadata:
         if self.tombstoneLineIndex is not None:
             d["tmb"] = self.tombstoneLineIndex
 
+        if self.partitionIndexLineIndex is not None:
+            d["pi"] = self.partitionIndexLineIndex
+
+        if self.batchID is not None:
+            d["b"] = self.batchID
+
         return json.dumps(d)
 
     def __str__(self):
@@ -218,104 +607,475 @@ class LogMetadata:
 
 
 def LogMetadataFromJSON(jsonl: dict):
-    lm = LogMetadata(jsonl["v"], jsonl["sch"], jsonl["f"], jsonl["tmb"] if "tmb" in jsonl else None)
+    lm = LogMetadata(jsonl["v"], jsonl["sch"], jsonl["f"], jsonl["tmb"] if "tmb" in jsonl else None,
+                     partitionIndexLineIndex=jsonl["pi"] if "pi" in jsonl else None,
+                     batchID=jsonl["b"] if "b" in jsonl else None)
     lm.timestamp = jsonl["t"]
     return lm
 
 
+class LogSnapshot:
+    """
+    The accumulated state of an ordered set of log files. Applying log files must happen in sorted key order, as
+    later file markers and log tombstones override earlier ones.
+    """
+    schema: Schema
+    file_markers: FileMarkerSet
+    tombstones: Dict[str, LogTombstone]
+    log_files: list[str]
+
+    def __init__(self):
+        self.schema = Schema()
+        self.file_markers = FileMarkerSet()
+        self.tombstones = {}
+        self.log_files = []
+
+    def apply(self, file: str, schema: dict, tombstones: list[LogTombstone], file_markers: Iterable[FileMarker]):
+        self.log_files.append(file)
+        self.schema.accumulate(list(schema.keys()), list(schema.values()))
+
+        for tmb in tombstones:
+            self.tombstones[tmb.path] = tmb
+
+        if len(self.file_markers) == 0 and isinstance(file_markers, FileMarkerSet):
+            # the first log file applied, its decoded markers are the state as-is
+            self.file_markers = file_markers
+        else:
+            self.file_markers.extend(file_markers)
+
+    def state(self) -> tuple[Schema, FileMarkerSet, list[LogTombstone], list[str]]:
+        """
+        Returns copies of the accumulated schema, file markers, log tombstones, and the log files applied, so
+        callers are free to modify them without affecting the snapshot.
+        """
+        schema = Schema()
+        schema.accumulate(self.schema.columns(), self.schema.types())
+        tombstones = list(map(lambda x: LogTombstone(x.path, x.createdMS), self.tombstones.values()))
+        return schema, self.file_markers.copy(), tombstones, list(self.log_files)
+
+    def toJSON(self) -> str:
+        # source log files are referenced by index to avoid repeating them on every marker
+        log_file_index = {log_file: i for i, log_file in enumerate(self.log_files)}
+        markers = []
+        for row in range(len(self.file_markers)):
+            d = {
+                "p": self.file_markers.path(row),
+                "b": self.file_markers._bytes[row],
+                "t": self.file_markers._created[row],
+            }
+            tombstone = self.file_markers.tombstone(row)
+            if tombstone is not None:
+                d["tmb"] = tombstone
+            source_log_file = self.file_markers.source_log_file(row)
+            if source_log_file in log_file_index:
+                d["l"] = log_file_index[source_log_file]
+            markers.append(d)
+        return json.dumps({
+            "l": self.log_files,
+            "sch": self.schema.d,
+            "tmb": list(map(lambda x: {"p": x.path, "t": x.createdMS}, self.tombstones.values())),
+            "f": markers
+        })
+
+
+def LogSnapshotFromJSON(jsonl: dict):
+    snap = LogSnapshot()
+    snap.log_files = list(jsonl["l"])
+    snap.schema.accumulate(list(jsonl["sch"].keys()), list(jsonl["sch"].values()))
+    for tmb_json in jsonl["tmb"]:
+        tmb = LogTombstoneFromJSON(tmb_json)
+        snap.tombstones[tmb.path] = tmb
+    for fm_json in jsonl["f"]:
+        snap.file_markers.put(fm_json["p"], int(fm_json["t"]), int(fm_json["b"]),
+                              fm_json["tmb"] if "tmb" in fm_json else None,
+                              snap.log_files[fm_json["l"]] if "l" in fm_json else None)
+    return snap
+
+
 class IceLogIO:
     path_safe_hostname: str
+    read_concurrency: int
+    snapshot_cache: bool
+    snapshot_cache_dir: str | None
+    snapshot_store_interval_ms: int
+    snapshots: Dict[str, LogSnapshot]
+    last_snapshot_store: Dict[str, int]
+    snapshot_lock: threading.Lock
+    use_checkpoints: bool
+    listing_lag_ms: int
+    full_listing_interval_ms: int
+    last_full_listing: Dict[str, int]
+    compression: str | None
+    schemas: Dict[str, Dict[str, dict]]
+    schema_lock: threading.Lock
+
+    def __init__(self, path_safe_hostname: str, read_concurrency: int = 1, snapshot_cache: bool = False,
+                 snapshot_cache_dir: str = None, use_checkpoints: bool = False, listing_lag_ms: int = 10_000,
+                 full_listing_interval_ms: int = 60_000, compression: str = None,
+                 snapshot_store_interval_ms: int = 60_000):
+        """
+        `read_concurrency` is the number of log files that will be fetched and parsed concurrently when reading the
+        state. The default of 1 reads them serially.
+
+        If `snapshot_cache` is enabled, the state read by `read_at_max_time` is kept in memory (and in
+        `snapshot_cache_dir` if provided) so that later reads only fetch log files that were created since. The
+        cache is rebuilt from scratch if any log file it has applied disappears, or a new log file sorts before the
+        last one it applied. A rebuilt snapshot is written to `snapshot_cache_dir` right away, and updates to it at
+        most every `snapshot_store_interval_ms`, so a restart replays at most that much of the log.
+
+        If `use_checkpoints` is enabled, `read_at_max_time` starts from the newest checkpoint (see `checkpoint`) at or
+        before the requested time and only replays the log files that came after it.
 
-    def __init__(self, path_safe_hostname: str):
+        Both of the above list the log incrementally with `get_log_files_after`, starting `listing_lag_ms` before the
+        newest log file they know about. The snapshot cache still does a full listing at least every
+        `full_listing_interval_ms`, or whenever a new merged log file appears, to notice deleted log files.
+
+        `compression` ("gzip" or "zstd") compresses the log files and checkpoints this instance writes, adding a
+        `.gz` or `.zst` suffix to their keys. Compressed files are always decompressed transparently when read,
+        regardless of this setting.
+        """
         self.path_safe_hostname = path_safe_hostname
+        self.read_concurrency = read_concurrency
+        self.snapshot_cache = snapshot_cache or snapshot_cache_dir is not None
+        self.snapshot_cache_dir = snapshot_cache_dir
+        self.snapshot_store_interval_ms = snapshot_store_interval_ms
+        self.snapshots = {}
+        self.last_snapshot_store = {}
+        self.snapshot_lock = threading.Lock()
+        self.use_checkpoints = use_checkpoints
+        self.listing_lag_ms = listing_lag_ms
+        self.full_listing_interval_ms = full_listing_interval_ms
+        self.last_full_listing = {}
+        if compression is not None and compression not in LOG_COMPRESSION_SUFFIXES:
+            raise AttributeError(f"invalid log compression '{compression}', must be one of "
+                                 f"{', '.join(LOG_COMPRESSION_SUFFIXES.keys())}")
+        self.compression = compression
+        self.schemas = {}
+        self.schema_lock = threading.Lock()
+
+    def read_log_file(self, s3client: S3Client, file: str, partition_filter: Callable[[str], bool] = None) -> tuple[
+        LogMetadata, dict, list[LogTombstone], FileMarkerSet]:
+        """
+        Fetches and parses a single log file of any version, without applying it to any state.
+
+        If `partition_filter` is provided, only the file markers whose partition it returns True for are returned. Log
+        files with a partition index only parse the lines of the matching partitions.
+
+        Returns the log metadata, schema, log tombstones, and file markers in the order they appear in the file.
+        """
+        obj = s3client.s3.get_object(
+            Bucket=s3client.s3bucket,
+            Key=file
+        )
+        # The body is decoded as it streams in, so only a chunk (or record batch) of it is held in memory at a time
+        body = obj['Body']
+        try:
+            stream, file_name = open_log_stream(body, file)
+            if file_name.endswith(ARROW_LOG_SUFFIX):
+                return self.__decode_arrow(stream, file, partition_filter)
+            return self.__decode_jsonl(stream, file, partition_filter)
+        finally:
+            # reading may stop early once past the wanted partitions
+            body.close()
+
+    def __decode_jsonl(self, stream, file: str, partition_filter: Callable[[str], bool] = None) -> tuple[
+        LogMetadata, dict, list[LogTombstone], FileMarkerSet]:
+        lines = iter_log_lines(stream)
+        meta = LogMetadataFromJSON(json.loads(next(lines)))
+
+        schema = {}
+        tombstones: list[LogTombstone] = []
+        file_markers = FileMarkerSet()
+        file_ranges: list[tuple[int, int]] | None = None  # the line ranges of the wanted partitions, if indexed
+        range_index = 0
+        for i, line in enumerate(lines, start=1):
+            if i >= meta.fileLineIndex:
+                # Files
+                if file_ranges is not None:
+                    while range_index < len(file_ranges) and file_ranges[range_index][1] <= i:
+                        range_index += 1
+                    if range_index == len(file_ranges):
+                        break  # the rest of the file is other partitions
+                    if i < file_ranges[range_index][0]:
+                        continue
+                fm_json = json.loads(line)
+                if partition_filter is not None and not partition_filter(get_file_partition(fm_json["p"])):
+                    continue
+                file_markers.put(fm_json["p"], int(fm_json["t"]), int(fm_json["b"]),
+                                 fm_json["tmb"] if "tmb" in fm_json else None, file)
+            elif meta.tombstoneLineIndex is not None and i >= meta.tombstoneLineIndex:
+                # Log tombstones
+                tmb_dict = json.loads(line)
+                tombstones.append(LogTombstone(tmb_dict["p"], int(tmb_dict["t"])))
+            elif i == meta.schemaLineIndex:
+                schema = dict(json.loads(line))
+            elif i == meta.partitionIndexLineIndex and partition_filter is not None:
+                file_ranges = partition_line_ranges(json.loads(line), partition_filter)
+                partition_filter = None  # applied by the line ranges instead
+
+        return meta, schema, tombstones, file_markers
+
+    def __decode_arrow(self, stream, file: str, partition_filter: Callable[[str], bool] = None) -> tuple[
+        LogMetadata, dict, list[LogTombstone], FileMarkerSet]:
+        reader = pa.ipc.open_stream(stream)
+        meta = LogMetadataFromJSON(json.loads(reader.schema.metadata[b"meta"]))
+        schema = dict(json.loads(reader.schema.metadata[b"schema"]))
+
+        # rows begin at the first log tombstone or file marker line
+        row_offset = meta.tombstoneLineIndex if meta.tombstoneLineIndex is not None else meta.fileLineIndex
+
+        # [start, end) row ranges to read, and whether they are log tombstones. An end of None reads to the end.
+        row_ranges: list[tuple[int, int | None, bool]] = []
+        if meta.tombstoneLineIndex is not None:
+            row_ranges.append((0, meta.fileLineIndex - row_offset, True))
+        if partition_filter is not None and meta.partitionIndexLineIndex is not None:
+            index = json.loads(reader.schema.metadata[b"partitions"])
+            for start, end in partition_line_ranges(index, partition_filter):
+                row_ranges.append((start - row_offset, end - row_offset, False))
+            partition_filter = None  # applied by the row ranges instead
+        else:
+            row_ranges.append((meta.fileLineIndex - row_offset, None, False))
+        last_row = row_ranges[-1][1] if len(row_ranges) > 0 else 0
+
+        tombstones: list[LogTombstone] = []
+        file_columns: list[pa.RecordBatch] = []
+        batch_start = 0
+        for batch in reader:
+            if last_row is not None and batch_start >= last_row:
+                break  # the rest of the file is other partitions
+            batch_end = batch_start + batch.num_rows
+            for start, end, is_tombstone in row_ranges:
+                start = max(start, batch_start)
+                end = batch_end if end is None else min(end, batch_end)
+                if start >= end:
+                    continue
+                rows = batch.slice(start - batch_start, end - start)
+                if is_tombstone:
+                    for path, created_ms in zip(rows.column("p").to_pylist(), rows.column("t").to_pylist()):
+                        tombstones.append(LogTombstone(path, created_ms))
+                    continue
+                file_columns.append(rows)
+            batch_start = batch_end
+
+        # Whole columns are ingested at once, rather than a marker at a time
+        file_markers = FileMarkerSet()
+        if len(file_columns) > 0:
+            rows = pa.Table.from_batches(file_columns).combine_chunks()
+            file_markers.put_columns(rows.column("p").chunk(0), rows.column("t").chunk(0), rows.column("b").chunk(0),
+                                     rows.column("tmb").chunk(0), file)
+        if partition_filter is not None:
+            file_markers = file_markers.in_partitions(partition_filter)
+
+        return meta, schema, tombstones, file_markers
+
+    def read_schema(self, s3client: S3Client) -> Schema:
+        """
+        Reads the accumulated schema of the table without reading the rest of the log, for example so ingestion
+        nodes can validate rows before inserting.
 
-    def read_log_forward(self, s3client: S3Client, s3_files: list[str]) -> tuple[Schema, list[FileMarker],
+        Only the metadata and schema lines at the start of each log file are fetched with ranged GETs, in parallel
+        with `read_concurrency`. The schema of each log file is cached as log files never change, and after the first
+        call only log files newer than the ones already known are listed. Deleted log files do not matter here, as
+        columns are never removed from the schema.
+        """
+        cache_key = self.__snapshot_cache_key(s3client)
+        with self.schema_lock:
+            if cache_key not in self.schemas:
+                self.schemas[cache_key] = {}
+            known = self.schemas[cache_key]
+            if len(known) == 0:
+                log_files = sorted(map(lambda x: x['Key'], self.get_current_log_files(s3client)))
+            else:
+                log_files = self.get_log_files_after(s3client, max(known.keys()))
+            new_files = list(filter(lambda x: x not in known, log_files))
+            if len(known) == 0 and len(new_files) == 0:
+                raise NoLogFilesException
+
+            if self.read_concurrency <= 1 or len(new_files) <= 1:
+                for file in new_files:
+                    known[file] = self.read_log_schema(s3client, file)
+            else:
+                with concurrent.futures.ThreadPoolExecutor(
+                        max_workers=min(self.read_concurrency, len(new_files))) as executor:
+                    for file, schema in zip(new_files,
+                                            executor.map(lambda x: self.read_log_schema(s3client, x), new_files)):
+                        known[file] = schema
+
+            total_schema = Schema()
+            for file in sorted(known.keys()):
+                total_schema.accumulate(list(known[file].keys()), list(known[file].values()))
+            return total_schema
+
+    def read_log_schema(self, s3client: S3Client, file: str, range_bytes: int = 16_384) -> dict:
+        """
+        Reads only the schema of a single log file, fetching the first `range_bytes` of the file and growing the
+        range until the schema is found. Compressed log files can't be read by range, so they are decompressed as they
+        stream in, and the download is stopped once the schema is read.
+        """
+        if file.endswith(tuple(LOG_COMPRESSION_SUFFIXES.values())):
+            body = s3client.s3.get_object(Bucket=s3client.s3bucket, Key=file)['Body']
+            try:
+                stream, file_name = open_log_stream(body, file)
+                if file_name.endswith(ARROW_LOG_SUFFIX):
+                    return dict(json.loads(pa.ipc.open_stream(stream).schema.metadata[b"schema"]))
+                lines = iter_log_lines(stream, range_bytes)
+                meta = LogMetadataFromJSON(json.loads(next(lines)))
+                for i, line in enumerate(lines, start=1):
+                    if i == meta.schemaLineIndex:
+                        return dict(json.loads(line))
+                return {}
+            finally:
+                body.close()
+
+        while True:
+            obj = s3client.s3.get_object(
+                Bucket=s3client.s3bucket,
+                Key=file,
+                Range=f"bytes=0-{range_bytes - 1}"
+            )
+            body = obj['Body'].read()
+            complete = len(body) < range_bytes
+            if file.endswith(ARROW_LOG_SUFFIX):
+                try:
+                    # The stream schema message, which holds the metadata, comes before any rows
+                    return dict(json.loads(pa.ipc.open_stream(body).schema.metadata[b"schema"]))
+                except pa.ArrowInvalid:
+                    if complete:
+                        raise
+            else:
+                lines = body.split(b"\n")
+                # the last line may have been cut off by the range
+                whole_lines = lines if complete else lines[:-1]
+                if len(whole_lines) > 0:
+                    meta = LogMetadataFromJSON(json.loads(whole_lines[0]))
+                    if meta.schemaLineIndex < len(whole_lines) or complete:
+                        return dict(json.loads(whole_lines[meta.schemaLineIndex]))
+            range_bytes *= 4
+
+    def read_log_files(self, s3client: S3Client, s3_files: list[str], concurrency: int = None,
+                       partition_filter: Callable[[str], bool] = None):
+        """
+        Fetches and parses the given log files with up to `concurrency` (defaults to `read_concurrency`) in flight at
+        a time, yielding the results of `read_log_file` in the same order as `s3_files`.
+        """
+        concurrency = self.read_concurrency if concurrency is None else concurrency
+        if concurrency <= 1 or len(s3_files) <= 1:
+            for file in s3_files:
+                yield self.read_log_file(s3client, file, partition_filter)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(concurrency, len(s3_files))) as executor:
+            # at most `concurrency` files are submitted ahead of the caller, so parsed files don't pile up in memory
+            # when it applies them slower than they are read. Results are yielded in submission order, so the caller
+            # still applies them in key order.
+            in_flight: deque[concurrent.futures.Future] = deque()
+            files = iter(s3_files)
+            try:
+                for file in itertools.islice(files, concurrency):
+                    in_flight.append(executor.submit(self.read_log_file, s3client, file, partition_filter))
+                while len(in_flight) > 0:
+                    result = in_flight.popleft().result()
+                    file = next(files, None)
+                    if file is not None:
+                        in_flight.append(executor.submit(self.read_log_file, s3client, file, partition_filter))
+                    yield result
+            finally:
+                # the caller stopped early, or a read failed
+                for future in in_flight:
+                    future.cancel()
+
+    def read_log_forward(self, s3client: S3Client, s3_files: list[str], concurrency: int = None,
+                         partition_filter: Callable[[str], bool] = None) -> tuple[Schema, FileMarkerSet,
     list[LogTombstone]]:
         """
         Reads the current state of the log for a given set of files, not meant to be used externally.
 
+        Log files are fetched with up to `concurrency` (defaults to `read_concurrency`) in flight, but are always
+        applied in sorted order so later files override earlier ones.
+
+        If `partition_filter` is provided, only the file markers of the partitions it returns True for are read.
+
         Returns the schema, file markers, log tombstones, and the list of log files read.
         """
-        total_schema = Schema()
-        file_markers: Dict[str, FileMarker] = {}
-        tombstones: Dict[str, LogTombstone] = {}
-        log_files: list[str] = []
-        # ensure they are sorted
-        s3_files = sorted(s3_files)
+        snapshot = self.__read_into(s3client, LogSnapshot(), sorted(s3_files), concurrency, partition_filter)
 
-        for file in s3_files:
-            log_files.append(file)
-            obj = s3client.s3.get_object(
-                Bucket=s3client.s3bucket,
-                Key=file
-            )
-            jsonl = str(obj['Body'].read(), encoding="utf-8").split("\n")
-            meta_json = json.loads(jsonl[0])
-            meta = LogMetadataFromJSON(meta_json)
-
-            # Schema
-            schema = dict(json.loads(jsonl[meta.schemaLineIndex]))
-            total_schema.accumulate(list(schema.keys()), list(schema.values()))
-
-            # Log tombstones
-            if meta.tombstoneLineIndex is not None:
-                for i in range(meta.tombstoneLineIndex, meta.fileLineIndex):
-                    tmb_dict = dict(json.loads(jsonl[i]))
-                    tombstones[tmb_dict["p"]] = LogTombstone(tmb_dict["p"], int(tmb_dict["t"]))
-
-            # Files
-            for i in range(meta.fileLineIndex, len(jsonl)):
-                fm_json = dict(json.loads(jsonl[i]))
-
-                # Otherwise add if not exists
-                fm = FileMarker(fm_json["p"], int(fm_json["t"]), int(fm_json["b"]),
-                                fm_json["tmb"] if "tmb" in fm_json else None)
-                fm.vir_source_log_file = file
-                file_markers[fm_json["p"]] = fm
-
-        if len(log_files) == 0:
+        if len(snapshot.log_files) == 0:
             raise NoLogFilesException
 
-        return total_schema, list(file_markers.values()), list(tombstones.values())
+        return snapshot.schema, snapshot.file_markers, list(snapshot.tombstones.values())
 
-    def get_current_log_files(self, s3client: S3Client) -> list[dict]:
+    def __read_into(self, s3client: S3Client, snapshot: LogSnapshot, s3_files: list[str],
+                    concurrency: int = None, partition_filter: Callable[[str], bool] = None) -> LogSnapshot:
         """
-        Returns the list of known log files as S3 object dictionaries
+        Applies the given log files to the snapshot, in the order provided.
         """
-        s3_files: list[dict] = []
-        no_more_files = False
-        continuation_token = ""
-        while not no_more_files:
-            res = s3client.s3.list_objects_v2(
-                Bucket=s3client.s3bucket,
-                MaxKeys=1000,
-                Prefix='/'.join([s3client.s3prefix, '_log']),
-                ContinuationToken=continuation_token
-            ) if continuation_token != "" else s3client.s3.list_objects_v2(
-                Bucket=s3client.s3bucket,
-                MaxKeys=1000,
-                Prefix='/'.join([s3client.s3prefix, '_log'])
-            )
-            if 'Contents' not in res:
-                return []
-            s3_files += res['Contents']
-            no_more_files = not res['IsTruncated']
-            if not no_more_files:
-                continuation_token = res['NextContinuationToken']
+        for file, (meta, schema, log_tombstones, markers) in zip(s3_files, self.read_log_files(s3client, s3_files,
+                                                                                               concurrency,
+                                                                                               partition_filter)):
+            snapshot.apply(file, schema, log_tombstones, markers)
+        return snapshot
 
-        if len(s3_files) == 0:
-            raise NoLogFilesException
+    def get_current_log_files(self, s3client: S3Client, start_after: str = None) -> list[dict]:
+        """
+        Returns the list of known log files as S3 object dictionaries.
 
-        return s3_files
+        If `start_after` is provided, only log files with keys sorting after it are listed. Log file keys begin with
+        their millisecond timestamp, so this lets a reader that already knows the older log files list only the newer
+        ones.
+        """
+        return self.__list_objects(s3client, '/'.join([s3client.s3prefix, '_log']), start_after)
 
-    def read_at_max_time(self, s3client: S3Client, timestamp: int) -> tuple[Schema, list[FileMarker],
-    list[LogTombstone], list[str]]:
+    def get_log_files_after(self, s3client: S3Client, last_log_file: str, lag_ms: int = None) -> list[str]:
+        """
+        Incrementally lists the log file keys newer than the last known log file, sorted.
+
+        Log files can become visible slightly out of order (their key timestamp is taken before they are uploaded),
+        so the listing starts `lag_ms` (defaults to `listing_lag_ms`) before the timestamp of `last_log_file`. Callers
+        must check the returned keys against the ones they already know about, and that none of the new ones sort
+        before `last_log_file`.
+        """
+        start_after = self.__listing_start_after(s3client, last_log_file, lag_ms)
+        return sorted(map(lambda x: x['Key'], self.get_current_log_files(s3client, start_after)))
+
+    def __listing_start_after(self, s3client: S3Client, last_log_file: str, lag_ms: int = None) -> str:
+        lag_ms = self.listing_lag_ms if lag_ms is None else lag_ms
+        return '/'.join([s3client.s3prefix, '_log', str(get_log_file_info(last_log_file)[0] - lag_ms)])
+
+    def read_at_max_time(self, s3client: S3Client, timestamp: int, partition_filter: Callable[[str], bool] = None) -> \
+            tuple[Schema, FileMarkerSet, list[LogTombstone], list[str]]:
         """
         Read the current state of the log up to a given timestamp.
 
+        If `partition_filter` is provided, only the file markers of the partitions it returns True for are returned,
+        for example `lambda p: p.startswith("u=user_a/")`. Log files with a partition index skip parsing the file
+        markers of the other partitions. Log tombstones and the schema are always returned in full.
+
         Returns the schema, file markers, log tombstones, and the list of log files read.
         """
+        if self.snapshot_cache:
+            schema, file_markers, log_tombstones, log_files = self.__read_cached(s3client, timestamp)
+            if partition_filter is not None:
+                file_markers = file_markers.in_partitions(partition_filter)
+            return schema, file_markers, log_tombstones, log_files
+
+        if self.use_checkpoints:
+            snapshot = self.__read_from_checkpoint(s3client, timestamp)
+            file_markers = snapshot.file_markers
+            if partition_filter is not None:
+                file_markers = file_markers.in_partitions(partition_filter)
+            return snapshot.schema, file_markers, list(snapshot.tombstones.values()), snapshot.log_files
+
+        log_files, _ = self.__list_log_files(s3client, timestamp)
+        schema, file_markers, log_tombstones = self.read_log_forward(s3client, log_files,
+                                                                     partition_filter=partition_filter)
+        return schema, file_markers, log_tombstones, log_files
+
+    def __list_log_files(self, s3client: S3Client, timestamp: int) -> tuple[list[str], set[str]]:
+        """
+        Fully lists the log files, returning the ones before the timestamp, and the set of all of them.
+        """
         s3_files = self.get_current_log_files(s3client)
+        all_log_files = set(map(lambda x: x['Key'], s3_files))
 
         # Filter out files that are too old
         s3_files = list(filter(lambda x: get_log_file_info(x['Key'])[0] < timestamp, s3_files))
@@ -323,39 +1083,378 @@ class IceLogIO:
         if len(s3_files) == 0:
             raise NoLogFilesException
 
-        log_files = list(map(lambda x: x['Key'], s3_files))
-        schema, file_markers, log_tombstones = self.read_log_forward(s3client, log_files)
-        return schema, file_markers, log_tombstones, log_files
+        return list(map(lambda x: x['Key'], s3_files)), all_log_files
+
+    def __list_new_log_files(self, s3client: S3Client, snapshot: LogSnapshot, timestamp: int) -> list[str] | None:
+        """
+        Incrementally lists the log files before the timestamp that the snapshot has not applied yet.
+
+        Returns None if that is not safe, and a full listing is needed: a recent log file the snapshot applied was
+        deleted, a new log file sorts before the last applied one, or a new merged log file exists (merges and
+        tombstone cleanup may have deleted older log files).
+        """
+        listed = list(filter(lambda x: get_log_file_info(x)[0] < timestamp,
+                             self.get_log_files_after(s3client, snapshot.log_files[-1])))
+
+        # the applied log files that the listing covered must all still exist
+        start_after = self.__listing_start_after(s3client, snapshot.log_files[-1])
+        recent = set(snapshot.log_files[bisect.bisect_right(snapshot.log_files, start_after):])
+        if not recent.issubset(listed):
+            return None
+
+        new_files = list(filter(lambda x: x not in recent, listed))
+        if len(new_files) > 0 and new_files[0] < snapshot.log_files[-1]:
+            return None
+        if any(map(lambda x: get_log_file_info(x)[1], new_files)):
+            return None
+        return new_files
+
+    def __read_cached(self, s3client: S3Client, timestamp: int) -> tuple[Schema, FileMarkerSet, list[LogTombstone],
+    list[str]]:
+        """
+        Reads the state up to the timestamp, only fetching the log files that the cached snapshot has not applied
+        yet. Listing is incremental as well, falling back to a full listing at least every `full_listing_interval_ms`
+        so deleted log files are noticed.
+        """
+        cache_key = self.__snapshot_cache_key(s3client)
+        time_travel = False
+        with self.snapshot_lock:
+            snapshot = self.snapshots.get(cache_key)
+            if snapshot is None:
+                snapshot = self.__load_snapshot(cache_key)
+                if snapshot is not None:
+                    self.snapshots[cache_key] = snapshot
+                    self.last_snapshot_store[cache_key] = round(time() * 1000)
+            if snapshot is not None and len(snapshot.log_files) > 0 \
+                    and get_log_file_info(snapshot.log_files[-1])[0] < timestamp \
+                    and round(time() * 1000) - self.last_full_listing.get(cache_key, 0) < self.full_listing_interval_ms:
+                new_files = self.__list_new_log_files(s3client, snapshot, timestamp)
+                if new_files is not None:
+                    if len(new_files) > 0:
+                        self.__read_into(s3client, snapshot, new_files)
+                        self.__store_snapshot(cache_key, snapshot)
+                    return snapshot.state()
+
+            log_files, all_log_files = self.__list_log_files(s3client, timestamp)
+            self.last_full_listing[cache_key] = round(time() * 1000)
+            log_files = sorted(log_files)
+            new_files = log_files
+            if snapshot is not None:
+                applied = set(snapshot.log_files)
+                if not applied.issubset(all_log_files):
+                    # an applied log file was deleted (e.g. by tombstone cleanup), so the snapshot is stale
+                    snapshot = None
+                elif not applied.issubset(log_files):
+                    # the snapshot is newer than the requested time
+                    time_travel = True
+                else:
+                    new_files = list(filter(lambda x: x not in applied, log_files))
+                    if len(new_files) > 0 and len(snapshot.log_files) > 0 and new_files[0] < snapshot.log_files[-1]:
+                        # a log file showed up out of order, it must be applied before ones we already have
+                        snapshot = None
+                        new_files = log_files
+
+            if not time_travel:
+                if snapshot is None:
+                    snapshot = self.__read_from_checkpoint(s3client, timestamp, log_files) if self.use_checkpoints \
+                        else self.__read_into(s3client, LogSnapshot(), log_files)
+                    self.snapshots[cache_key] = snapshot
+                    self.__store_snapshot(cache_key, snapshot, force=True)
+                elif len(new_files) > 0:
+                    self.__read_into(s3client, snapshot, new_files)
+                    self.__store_snapshot(cache_key, snapshot)
+                return snapshot.state()
+
+        # reads from before the cached snapshot are read in full, and are not cached
+        if self.use_checkpoints:
+            return self.__read_from_checkpoint(s3client, timestamp, log_files).state()
+        return self.__read_into(s3client, LogSnapshot(), log_files).state()
+
+    def __read_from_checkpoint(self, s3client: S3Client, timestamp: int, log_files: list[str] = None) -> LogSnapshot:
+        """
+        Reads the state up to the timestamp, starting from the newest checkpoint at or before it if one exists.
+
+        If the sorted `log_files` are not provided, only the log files after the checkpoint are listed.
+        """
+        snapshot = self.read_checkpoint(s3client, timestamp)
+        if snapshot is not None and len(snapshot.log_files) > 0:
+            if log_files is None:
+                listed = list(filter(lambda x: get_log_file_info(x)[0] < timestamp,
+                                     self.get_log_files_after(s3client, snapshot.log_files[-1])))
+            else:
+                listed = log_files
+            covered = set(snapshot.log_files)
+            new_files = list(filter(lambda x: x not in covered, listed))
+            if len(new_files) == 0 or new_files[0] > snapshot.log_files[-1]:
+                return self.__read_into(s3client, snapshot, new_files)
+            # otherwise a log file that the checkpoint missed sorts before the ones it covers, so it cannot be
+            # replayed on top of it
+
+        if log_files is None:
+            log_files, _ = self.__list_log_files(s3client, timestamp)
+        return self.__read_into(s3client, LogSnapshot(), sorted(log_files))
+
+    def __snapshot_cache_key(self, s3client: S3Client) -> str:
+        return '/'.join([s3client.s3bucket, s3client.s3prefix])
+
+    def __snapshot_cache_path(self, cache_key: str) -> str:
+        return os.path.join(self.snapshot_cache_dir, cache_key.replace('/', '_') + '.json')
+
+    def __load_snapshot(self, cache_key: str) -> LogSnapshot | None:
+        if self.snapshot_cache_dir is None or not os.path.exists(self.__snapshot_cache_path(cache_key)):
+            return None
+        with open(self.__snapshot_cache_path(cache_key), 'r') as f:
+            return LogSnapshotFromJSON(json.load(f))
+
+    def __store_snapshot(self, cache_key: str, snapshot: LogSnapshot, force: bool = False):
+        """
+        Writes the snapshot to `snapshot_cache_dir`, unless it was written less than `snapshot_store_interval_ms` ago
+        and not forced. Serializing the whole snapshot on every read that applies a new log file would otherwise
+        dominate incremental reads.
+        """
+        if self.snapshot_cache_dir is None:
+            return
+        now = round(time() * 1000)
+        if not force and now - self.last_snapshot_store.get(cache_key, 0) < self.snapshot_store_interval_ms:
+            return
+        self.last_snapshot_store[cache_key] = now
+        os.makedirs(self.snapshot_cache_dir, exist_ok=True)
+        # write then rename so a crash never leaves a partial snapshot behind
+        tmp_path = self.__snapshot_cache_path(cache_key) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(snapshot.toJSON())
+        os.replace(tmp_path, self.__snapshot_cache_path(cache_key))
+
+    def checkpoint(self, s3client: S3Client, lag_ms: int = 60_000) -> tuple[str | None, int | None]:
+        """
+        Writes a checkpoint that collapses the state of every log file created more than `lag_ms` ago into a single
+        object, and points `_checkpoint/_latest` at it. Readers using checkpoints start from the newest checkpoint
+        at or before the time they read at, and only replay log files that came after it.
+
+        The lag avoids checkpointing right behind log files that are still being uploaded, which would otherwise show
+        up after the checkpoint and force readers back to a full read.
+
+        Returns the checkpoint path and the timestamp it covers up to (exclusive), or None if there were no log files
+        to checkpoint.
+        """
+        checkpoint_time = round(time() * 1000) - lag_ms
+        try:
+            schema, file_markers, log_tombstones, log_files = self.read_at_max_time(s3client, checkpoint_time)
+        except NoLogFilesException:
+            return None, None
+
+        snapshot = LogSnapshot()
+        snapshot.schema = schema
+        snapshot.log_files = log_files
+        snapshot.file_markers = file_markers
+        snapshot.tombstones = {tmb.path: tmb for tmb in log_tombstones}
+
+        checkpoint_body, checkpoint_key = self.__compress(bytes(snapshot.toJSON(), 'utf-8'), "/".join([
+            s3client.s3prefix, '_checkpoint', f"{checkpoint_time}_{self.path_safe_hostname}.json"]))
+        s3client.s3.put_object(
+            Body=checkpoint_body,
+            Bucket=s3client.s3bucket,
+            Key=checkpoint_key
+        )
+        s3client.s3.put_object(
+            Body=bytes(json.dumps({"k": checkpoint_key, "t": checkpoint_time}), 'utf-8'),
+            Bucket=s3client.s3bucket,
+            Key=self.__checkpoint_pointer_key(s3client)
+        )
+        return checkpoint_key, checkpoint_time
+
+    def read_checkpoint(self, s3client: S3Client, timestamp: int) -> LogSnapshot | None:
+        """
+        Reads the newest checkpoint at or before the timestamp, or None if there isn't one.
+        """
+        checkpoint_key = None
+        pointer = self.__get_json(s3client, self.__checkpoint_pointer_key(s3client))
+        if pointer is not None and pointer["t"] <= timestamp:
+            checkpoint_key = pointer["k"]
+        else:
+            # time travel to before the latest checkpoint, find the newest one that is old enough
+            checkpoint_keys = sorted(filter(lambda x: get_log_file_info(x)[0] <= timestamp,
+                                            self.get_checkpoint_files(s3client)))
+            if len(checkpoint_keys) > 0:
+                checkpoint_key = checkpoint_keys[-1]
+
+        if checkpoint_key is None:
+            return None
+
+        checkpoint = self.__get_json(s3client, checkpoint_key)
+        if checkpoint is None:
+            # deleted since we found it
+            return None
+        return LogSnapshotFromJSON(checkpoint)
+
+    def get_checkpoint_files(self, s3client: S3Client) -> list[str]:
+        """
+        Returns the list of checkpoint files, excluding the latest pointer
+        """
+        checkpoint_files = self.__list_objects(s3client, '/'.join([s3client.s3prefix, '_checkpoint', '']))
+        return list(filter(lambda x: not x.split("/")[-1].startswith("_"), map(lambda x: x['Key'], checkpoint_files)))
+
+    def delete_checkpoints(self, s3client: S3Client) -> list[str]:
+        """
+        Deletes all checkpoints and the latest pointer. Tombstone cleanup does this because it rewrites and deletes
+        log files that checkpoints cover.
 
-    def append(self, s3client: S3Client, version: int, schema: Schema, files: list[FileMarker], tombstones: list[
-        LogTombstone] = None, merged = False, timestamp: int = None) -> tuple[str, LogMetadata]:
+        Returns the list of checkpoint files deleted.
+        """
+        checkpoint_files = self.get_checkpoint_files(s3client)
+        s3client.s3.delete_object(
+            Bucket=s3client.s3bucket,
+            Key=self.__checkpoint_pointer_key(s3client)
+        )
+        for checkpoint_file in checkpoint_files:
+            s3client.s3.delete_object(
+                Bucket=s3client.s3bucket,
+                Key=checkpoint_file
+            )
+        return checkpoint_files
+
+    def __checkpoint_pointer_key(self, s3client: S3Client) -> str:
+        return '/'.join([s3client.s3prefix, '_checkpoint', '_latest.json'])
+
+    def __get_json(self, s3client: S3Client, key: str) -> dict | None:
+        try:
+            obj = s3client.s3.get_object(
+                Bucket=s3client.s3bucket,
+                Key=key
+            )
+        except s3client.s3.exceptions.NoSuchKey:
+            return None
+        return json.loads(decompress_log_body(obj['Body'].read(), key)[0])
+
+    def __list_objects(self, s3client: S3Client, prefix: str, start_after: str = None) -> list[dict]:
+        s3_files: list[dict] = []
+        no_more_files = False
+        continuation_token = ""
+        while not no_more_files:
+            list_args = {
+                "Bucket": s3client.s3bucket,
+                "MaxKeys": 1000,
+                "Prefix": prefix
+            }
+            if continuation_token != "":
+                list_args["ContinuationToken"] = continuation_token
+            elif start_after is not None:
+                list_args["StartAfter"] = start_after
+            res = s3client.s3.list_objects_v2(**list_args)
+            if 'Contents' not in res:
+                return s3_files
+            s3_files += res['Contents']
+            no_more_files = not res['IsTruncated']
+            if not no_more_files:
+                continuation_token = res['NextContinuationToken']
+        return s3_files
+
+    def append(self, s3client: S3Client, version: int, schema: Schema, files: Iterable[FileMarker], tombstones: list[
+        LogTombstone] = None, merged = False, timestamp: int = None, batch_id: str = None) -> tuple[str, LogMetadata]:
         """
         Creates a new log file in S3, in the order of version, schema, tombstones?, files
+
+        `batch_id` is recorded in the metadata of logs written by idempotent inserts.
+
+        `version` selects the encoding: `LOG_VERSION_JSONL` writes newline-delimited JSON, `LOG_VERSION_ARROW` writes
+        an Arrow IPC stream. Readers handle tables with a mix of both.
         """
+        if version not in (LOG_VERSION_JSONL, LOG_VERSION_ARROW):
+            raise AttributeError(f"invalid log version '{version}', must be one of {LOG_VERSION_JSONL}, "
+                                 f"{LOG_VERSION_ARROW}")
+
+        # File markers are grouped by partition, so the partition index holds a single line range per partition
+        partitioned_files = sorted(map(lambda x: (get_file_partition(x.path), x), files), key=lambda x: x[0])
+        files = list(map(lambda x: x[1], partitioned_files))
+
+        meta = LogMetadata(version, 1, 3 if tombstones is None or len(tombstones) == 0 else 3+len(tombstones),
+                           None if tombstones is None or len(tombstones) == 0 else 3, timestamp=timestamp,
+                           partitionIndexLineIndex=2, batchID=batch_id)
+
+        partition_index: dict[str, list[int]] = {}
+        for i, (partition, _) in enumerate(partitioned_files):
+            line = meta.fileLineIndex + i
+            if partition not in partition_index:
+                partition_index[partition] = [line, line + 1]
+            else:
+                partition_index[partition][1] = line + 1
+
+        file_key = self.log_file_key(s3client, version, meta.timestamp, merged)
+        if version == LOG_VERSION_ARROW:
+            body = self.__encode_arrow(meta, schema, partition_index, files, tombstones)
+        else:
+            body = self.__encode_jsonl(meta, schema, partition_index, files, tombstones)
+        body, _ = self.__compress(body, file_key)
+
+        # Upload the file to S3
+        s3client.s3.put_object(
+            Body=body,
+            Bucket=s3client.s3bucket,
+            Key=file_key
+        )
+        return file_key, meta
+
+    def log_file_key(self, s3client: S3Client, version: int, timestamp: int, merged=False) -> str:
+        """
+        Returns the key `append` writes a log file with the timestamp at
+        """
+        file_id = f"{timestamp}"
+        if merged:
+            file_id += "_m"
+        file_id += f"_{self.path_safe_hostname}"
+        file_key = "/".join([s3client.s3prefix, '_log', file_id + (ARROW_LOG_SUFFIX if version == LOG_VERSION_ARROW
+                                                                   else '.jsonl')])
+        if self.compression is not None:
+            file_key += LOG_COMPRESSION_SUFFIXES[self.compression]
+        return file_key
+
+    def __compress(self, body: bytes, key: str) -> tuple[bytes, str]:
+        """
+        Compresses the body with the configured compression, returning the body and the key with the compression
+        suffix added
+        """
+        if self.compression is None:
+            return body, key
+        sink = pa.BufferOutputStream()
+        with pa.CompressedOutputStream(sink, self.compression) as compressed:
+            compressed.write(body)
+        return sink.getvalue().to_pybytes(), key + LOG_COMPRESSION_SUFFIXES[self.compression]
+
+    def __encode_jsonl(self, meta: LogMetadata, schema: Schema, partition_index: dict[str, list[int]],
+                       files: list[FileMarker], tombstones: list[LogTombstone] | None) -> bytes:
         log_file_lines: list[str] = []
-        meta = LogMetadata(version, 1, 2 if tombstones is None or len(tombstones) == 0 else 2+len(tombstones),
-                           None if tombstones is None or len(tombstones) == 0 else 2, timestamp=timestamp)
         log_file_lines.append(meta.toJSON())
         log_file_lines.append(schema.toJSON())
+        log_file_lines.append(json.dumps(partition_index))
         if tombstones is not None:
             for tmb in tombstones:
                 log_file_lines.append(tmb.toJSON())
         for fileMarker in files:
             log_file_lines.append(fileMarker.json())
+        return bytes('\n'.join(log_file_lines), 'utf-8')
 
-        file_id = f"{meta.timestamp}"
-        if merged:
-            file_id += "_m"
-        file_id += f"_{self.path_safe_hostname}"
-
-        # Upload the file to S3
-        file_key = "/".join([s3client.s3prefix, '_log', file_id+'.jsonl'])
-        s3client.s3.put_object(
-            Body=bytes('\n'.join(log_file_lines), 'utf-8'),
-            Bucket=s3client.s3bucket,
-            Key=file_key
-        )
-        return file_key, meta
+    def __encode_arrow(self, meta: LogMetadata, schema: Schema, partition_index: dict[str, list[int]],
+                       files: list[FileMarker], tombstones: list[LogTombstone] | None) -> bytes:
+        """
+        Log tombstones and file markers share the same columns, log tombstones first with null `b` and `tmb`. The
+        metadata and partition index line indexes are the same as the equivalent JSONL file, so rows begin at the
+        first log tombstone or file marker line.
+        """
+        tombstones = tombstones if tombstones is not None else []
+        table = pa.table({
+            "p": [tmb.path for tmb in tombstones] + [fm.path for fm in files],
+            "b": [None] * len(tombstones) + [fm.fileBytes for fm in files],
+            "t": [tmb.createdMS for tmb in tombstones] + [fm.createdMS for fm in files],
+            "tmb": [None] * len(tombstones) + [fm.tombstone for fm in files]
+        }, schema=ARROW_LOG_SCHEMA.with_metadata({
+            "meta": meta.toJSON(),
+            "schema": schema.toJSON(),
+            "partitions": json.dumps(partition_index)
+        }))
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=ARROW_LOG_BATCH_ROWS)
+        return sink.getvalue().to_pybytes()
 
 def get_log_file_info(file_name: str) -> tuple[int, bool]:
     """
@@ -369,3 +1468,62 @@ def get_log_file_info(file_name: str) -> tuple[int, bool]:
     if len(name_parts) > 2 and name_parts[1] == "m":
         merged = True
     return file_ts, merged
+
+
+def get_file_partition(file_path: str) -> str:
+    """
+    Returns the partition of a data file, the path between `_data/` and the file name
+    """
+    path_parts = file_path.split("_data/")
+    base_path = path_parts[1] if len(path_parts) > 1 else path_parts[0]
+    # remove the file name
+    return '/'.join(base_path.split("/")[:-1])
+
+
+def partition_line_ranges(partition_index: dict[str, list[int]], partition_filter: Callable[[str], bool]) -> list[
+    tuple[int, int]]:
+    """
+    Returns the sorted [start, end) line ranges of the partitions in a log file's partition index that the filter
+    returns True for
+    """
+    return sorted(map(lambda x: (x[1][0], x[1][1]), filter(lambda x: partition_filter(x[0]),
+                                                           partition_index.items())))
+
+
+def open_log_stream(stream, file_name: str) -> tuple[object, str]:
+    """
+    Wraps a log file (or checkpoint) stream in a decompressing stream based on its key suffix, returning the stream
+    and the key without the compression suffix. Uncompressed streams are returned as-is.
+    """
+    for codec, suffix in LOG_COMPRESSION_SUFFIXES.items():
+        if file_name.endswith(suffix):
+            return pa.CompressedInputStream(pa.PythonFile(stream, mode='r'), codec), file_name[:-len(suffix)]
+    return stream, file_name
+
+
+def iter_log_lines(stream, chunk_size: int = LOG_READ_CHUNK_BYTES):
+    """
+    Yields the lines of a JSONL log file as bytes, reading `chunk_size` bytes from the stream at a time rather than
+    holding the whole body.
+    """
+    remainder = b""
+    while True:
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (remainder + chunk).split(b"\n")
+        remainder = lines.pop()
+        yield from lines
+    if len(remainder) > 0:
+        yield remainder
+
+
+def decompress_log_body(body: bytes, file_name: str) -> tuple[bytes, str]:
+    """
+    Decompresses a log file (or checkpoint) body based on its key suffix, returning the body and the key without the
+    compression suffix. Uncompressed bodies are returned as-is.
+    """
+    for codec, suffix in LOG_COMPRESSION_SUFFIXES.items():
+        if file_name.endswith(suffix):
+            return pa.CompressedInputStream(pa.py_buffer(body), codec).read(), file_name[:-len(suffix)]
+    return body, file_name
@@ -0,0 +1,362 @@
+"""
+Concatenates parquet files by copying their row groups byte for byte and writing a new footer, without decoding any
+data. Only the parts of the thrift compact protocol needed to read and rewrite the footer (FileMetaData) are
+implemented, and fields that are not understood are kept as they are.
+"""
+import os
+import struct
+
+PARQUET_MAGIC = b"PAR1"
+
+# parquet.thrift CompressionCodec
+PARQUET_CODECS = {
+    "UNCOMPRESSED": 0,
+    "SNAPPY": 1,
+    "GZIP": 2,
+    "ZSTD": 6,
+}
+
+# thrift compact protocol types
+T_STOP = 0
+T_BOOL_TRUE = 1
+T_BOOL_FALSE = 2
+T_BYTE = 3
+T_I16 = 4
+T_I32 = 5
+T_I64 = 6
+T_DOUBLE = 7
+T_BINARY = 8
+T_LIST = 9
+T_SET = 10
+T_MAP = 11
+T_STRUCT = 12
+
+# FileMetaData fields
+FMD_SCHEMA = 2
+FMD_NUM_ROWS = 3
+FMD_ROW_GROUPS = 4
+FMD_ENCRYPTION_ALGORITHM = 8
+
+# RowGroup fields
+RG_COLUMNS = 1
+RG_NUM_ROWS = 3
+RG_FILE_OFFSET = 5
+RG_ORDINAL = 7
+
+# ColumnChunk fields
+CC_FILE_PATH = 1
+CC_FILE_OFFSET = 2
+CC_META_DATA = 3
+CC_PAGE_INDEX = (4, 5, 6, 7)  # offset and column index offsets and lengths, the indexes are not copied
+CC_CRYPTO_METADATA = 8
+
+# ColumnMetaData fields
+CMD_CODEC = 4
+CMD_TOTAL_COMPRESSED_SIZE = 7
+CMD_DATA_PAGE_OFFSET = 9
+CMD_INDEX_PAGE_OFFSET = 10
+CMD_DICTIONARY_PAGE_OFFSET = 11
+CMD_BLOOM_FILTER = (14, 15)  # bloom filter offset and length, the filters are not copied
+
+
+class ThriftStruct:
+    """
+    A decoded thrift struct, keeping every field (in order) as (field id, type, value) so it can be written back.
+    Structs are ThriftStruct, lists and sets are (element type, list of values), and maps are
+    (key type, value type, list of (key, value)).
+    """
+    __slots__ = ("fields",)
+
+    fields: list[tuple[int, int, any]]
+
+    def __init__(self, fields: list[tuple[int, int, any]] = None):
+        self.fields = fields if fields is not None else []
+
+    def get(self, field_id: int, default=None):
+        for fid, _, value in self.fields:
+            if fid == field_id:
+                return value
+        return default
+
+    def set(self, field_id: int, field_type: int, value):
+        for i, (fid, _, _) in enumerate(self.fields):
+            if fid == field_id:
+                self.fields[i] = (field_id, field_type, value)
+                return
+        self.fields.append((field_id, field_type, value))
+        self.fields.sort(key=lambda x: x[0])
+
+    def remove(self, *field_ids: int):
+        self.fields = list(filter(lambda x: x[0] not in field_ids, self.fields))
+
+
+class ThriftCompactReader:
+    def __init__(self, buf: bytes):
+        self.buf = buf
+        self.pos = 0
+
+    def read_byte(self) -> int:
+        b = self.buf[self.pos]
+        self.pos += 1
+        return b
+
+    def read_varint(self) -> int:
+        result = 0
+        shift = 0
+        while True:
+            b = self.read_byte()
+            result |= (b & 0x7F) << shift
+            if b & 0x80 == 0:
+                return result
+            shift += 7
+
+    def read_zigzag(self) -> int:
+        n = self.read_varint()
+        return (n >> 1) ^ -(n & 1)
+
+    def read_value(self, value_type: int):
+        if value_type in (T_BOOL_TRUE, T_BOOL_FALSE):
+            # booleans inside collections are a byte each
+            return self.read_byte() == T_BOOL_TRUE
+        if value_type == T_BYTE:
+            return struct.unpack("b", bytes([self.read_byte()]))[0]
+        if value_type in (T_I16, T_I32, T_I64):
+            return self.read_zigzag()
+        if value_type == T_DOUBLE:
+            value = struct.unpack("<d", self.buf[self.pos:self.pos + 8])[0]
+            self.pos += 8
+            return value
+        if value_type == T_BINARY:
+            length = self.read_varint()
+            value = bytes(self.buf[self.pos:self.pos + length])
+            self.pos += length
+            return value
+        if value_type in (T_LIST, T_SET):
+            header = self.read_byte()
+            size = header >> 4
+            if size == 15:
+                size = self.read_varint()
+            element_type = header & 0x0F
+            return element_type, list(map(lambda _: self.read_value(element_type), range(size)))
+        if value_type == T_MAP:
+            size = self.read_varint()
+            if size == 0:
+                return 0, 0, []
+            types = self.read_byte()
+            key_type, val_type = types >> 4, types & 0x0F
+            return key_type, val_type, list(map(lambda _: (self.read_value(key_type), self.read_value(val_type)),
+                                                range(size)))
+        if value_type == T_STRUCT:
+            return self.read_struct()
+        raise ValueError(f"unknown thrift compact type {value_type}")
+
+    def read_struct(self) -> ThriftStruct:
+        fields = []
+        last_id = 0
+        while True:
+            header = self.read_byte()
+            field_type = header & 0x0F
+            if field_type == T_STOP:
+                return ThriftStruct(fields)
+            delta = header >> 4
+            field_id = last_id + delta if delta != 0 else self.read_zigzag()
+            if field_type in (T_BOOL_TRUE, T_BOOL_FALSE):
+                value = field_type == T_BOOL_TRUE
+            else:
+                value = self.read_value(field_type)
+            fields.append((field_id, field_type, value))
+            last_id = field_id
+
+
+class ThriftCompactWriter:
+    def __init__(self):
+        self.buf = bytearray()
+
+    def write_varint(self, n: int):
+        while True:
+            if n & ~0x7F == 0:
+                self.buf.append(n)
+                return
+            self.buf.append((n & 0x7F) | 0x80)
+            n >>= 7
+
+    def write_zigzag(self, n: int):
+        self.write_varint((n << 1) ^ (n >> 63))
+
+    def write_value(self, value_type: int, value):
+        if value_type in (T_BOOL_TRUE, T_BOOL_FALSE):
+            self.buf.append(T_BOOL_TRUE if value else T_BOOL_FALSE)
+        elif value_type == T_BYTE:
+            self.buf += struct.pack("b", value)
+        elif value_type in (T_I16, T_I32, T_I64):
+            self.write_zigzag(value)
+        elif value_type == T_DOUBLE:
+            self.buf += struct.pack("<d", value)
+        elif value_type == T_BINARY:
+            self.write_varint(len(value))
+            self.buf += value
+        elif value_type in (T_LIST, T_SET):
+            element_type, values = value
+            if len(values) < 15:
+                self.buf.append(len(values) << 4 | element_type)
+            else:
+                self.buf.append(0xF0 | element_type)
+                self.write_varint(len(values))
+            for v in values:
+                self.write_value(element_type, v)
+        elif value_type == T_MAP:
+            key_type, val_type, items = value
+            self.write_varint(len(items))
+            if len(items) > 0:
+                self.buf.append(key_type << 4 | val_type)
+                for k, v in items:
+                    self.write_value(key_type, k)
+                    self.write_value(val_type, v)
+        elif value_type == T_STRUCT:
+            self.write_struct(value)
+        else:
+            raise ValueError(f"unknown thrift compact type {value_type}")
+
+    def write_struct(self, s: ThriftStruct):
+        last_id = 0
+        for field_id, field_type, value in s.fields:
+            if field_type in (T_BOOL_TRUE, T_BOOL_FALSE):
+                field_type = T_BOOL_TRUE if value else T_BOOL_FALSE
+            delta = field_id - last_id
+            if 0 < delta <= 15:
+                self.buf.append(delta << 4 | field_type)
+            else:
+                self.buf.append(field_type)
+                self.write_zigzag(field_id)
+            if field_type not in (T_BOOL_TRUE, T_BOOL_FALSE):
+                self.write_value(field_type, value)
+            last_id = field_id
+        self.buf.append(T_STOP)
+
+
+def read_footer(f) -> ThriftStruct:
+    """
+    Reads the FileMetaData of a parquet file open for binary reading. Raises ValueError if it is not an (unencrypted)
+    parquet file.
+    """
+    f.seek(-8, os.SEEK_END)
+    tail = f.read(8)
+    if tail[4:] != PARQUET_MAGIC:
+        raise ValueError("not an unencrypted parquet file")
+    footer_length = struct.unpack("<I", tail[:4])[0]
+    f.seek(-8 - footer_length, os.SEEK_END)
+    return ThriftCompactReader(f.read(footer_length)).read_struct()
+
+
+def write_footer(s: ThriftStruct) -> bytes:
+    writer = ThriftCompactWriter()
+    writer.write_struct(s)
+    return bytes(writer.buf)
+
+
+def column_chunk_range(column_chunk: ThriftStruct) -> tuple[int, int]:
+    """
+    Returns the offset and length of a column chunk's pages
+    """
+    meta: ThriftStruct = column_chunk.get(CC_META_DATA)
+    start = meta.get(CMD_DATA_PAGE_OFFSET)
+    dictionary_offset = meta.get(CMD_DICTIONARY_PAGE_OFFSET)
+    # some writers set the dictionary page offset to 0 when there is none
+    if dictionary_offset is not None and 0 < dictionary_offset < start:
+        start = dictionary_offset
+    return start, meta.get(CMD_TOTAL_COMPRESSED_SIZE)
+
+
+def can_concat(footers: list[ThriftStruct], codec: int, min_row_group_rows: int = None) -> bool:
+    """
+    Whether the files can be concatenated: all of them have the same schema, every column chunk uses the codec, none
+    of them are encrypted, and their row groups average at least `min_row_group_rows` rows (if provided), since
+    concatenating keeps them as they are
+    """
+    if min_row_group_rows is not None:
+        row_groups = sum(map(lambda x: len(x.get(FMD_ROW_GROUPS, (T_STRUCT, []))[1]), footers))
+        rows = sum(map(lambda x: x.get(FMD_NUM_ROWS), footers))
+        if row_groups > 0 and rows / row_groups < min_row_group_rows:
+            return False
+
+    schema = write_footer(ThriftStruct([(FMD_SCHEMA, T_LIST, footers[0].get(FMD_SCHEMA))]))
+    for footer in footers:
+        if footer.get(FMD_ENCRYPTION_ALGORITHM) is not None:
+            return False
+        if write_footer(ThriftStruct([(FMD_SCHEMA, T_LIST, footer.get(FMD_SCHEMA))])) != schema:
+            return False
+        for row_group in footer.get(FMD_ROW_GROUPS, (T_STRUCT, []))[1]:
+            for column_chunk in row_group.get(RG_COLUMNS)[1]:
+                meta = column_chunk.get(CC_META_DATA)
+                if meta is None or column_chunk.get(CC_FILE_PATH) is not None or \
+                        column_chunk.get(CC_CRYPTO_METADATA) is not None or meta.get(CMD_CODEC) != codec:
+                    return False
+    return True
+
+
+def concat_files(paths: list[str], out_path: str, codec: int, min_row_group_rows: int = None,
+                 copy_buffer_bytes: int = 1024 * 1024) -> bool:
+    """
+    Concatenates the row groups of the parquet files into a new file at out_path, copying the column chunks byte for
+    byte and writing a footer with their new offsets. The footer is otherwise the first file's, with the row groups of
+    all of them.
+
+    Returns False without writing anything if the files can't be concatenated (see `can_concat`). Page indexes and
+    bloom filters are not copied, so they are removed from the footer.
+    """
+    footers = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            try:
+                footers.append(read_footer(f))
+            except (ValueError, IndexError, struct.error):
+                return False
+    if len(footers) == 0 or not can_concat(footers, codec, min_row_group_rows):
+        return False
+
+    row_groups: list[ThriftStruct] = []
+    num_rows = 0
+    with open(out_path, 'wb') as out:
+        out.write(PARQUET_MAGIC)
+        for path, footer in zip(paths, footers):
+            num_rows += footer.get(FMD_NUM_ROWS)
+            with open(path, 'rb') as f:
+                for row_group in footer.get(FMD_ROW_GROUPS, (T_STRUCT, []))[1]:
+                    row_group_offset = None
+                    for column_chunk in row_group.get(RG_COLUMNS)[1]:
+                        start, length = column_chunk_range(column_chunk)
+                        delta = out.tell() - start
+                        if row_group_offset is None:
+                            row_group_offset = out.tell()
+
+                        f.seek(start)
+                        remaining = length
+                        while remaining > 0:
+                            chunk = f.read(min(remaining, copy_buffer_bytes))
+                            if len(chunk) == 0:
+                                raise ValueError(f"unexpected end of parquet file {path}")
+                            out.write(chunk)
+                            remaining -= len(chunk)
+
+                        meta: ThriftStruct = column_chunk.get(CC_META_DATA)
+                        for field_id in (CMD_DATA_PAGE_OFFSET, CMD_INDEX_PAGE_OFFSET, CMD_DICTIONARY_PAGE_OFFSET):
+                            offset = meta.get(field_id)
+                            if offset is not None and (field_id == CMD_DATA_PAGE_OFFSET or offset > 0):
+                                meta.set(field_id, T_I64, offset + delta)
+                        meta.remove(*CMD_BLOOM_FILTER)
+                        column_chunk.set(CC_FILE_OFFSET, T_I64, column_chunk.get(CC_FILE_OFFSET, start) + delta)
+                        column_chunk.remove(*CC_PAGE_INDEX)
+
+                    if row_group_offset is not None:
+                        row_group.set(RG_FILE_OFFSET, T_I64, row_group_offset)
+                    row_group.set(RG_ORDINAL, T_I16, len(row_groups))
+                    row_groups.append(row_group)
+
+        footer = footers[0]
+        footer.set(FMD_NUM_ROWS, T_I64, num_rows)
+        footer.set(FMD_ROW_GROUPS, T_LIST, (T_STRUCT, row_groups))
+        footer_bytes = write_footer(footer)
+        out.write(footer_bytes)
+        out.write(struct.pack("<I", len(footer_bytes)))
+        out.write(PARQUET_MAGIC)
+    return True
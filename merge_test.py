@@ -0,0 +1,117 @@
+from icedb.icedb import IceDBv3, merge_sorted
+from icedb.log import S3Client
+from typing import Iterator
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import tempfile
+import random
+import os
+
+random.seed(42)
+schema = pa.schema([("a", pa.int64()), ("b", pa.string()), ("id", pa.string())])
+sort_keys = ["a", "b"]
+sort_by = [("a", "ascending"), ("b", "ascending")]
+
+
+def sorted_table(input_id: int, num_rows: int, null_fraction: float = 0.0) -> pa.Table:
+    def value(choices):
+        return None if random.random() < null_fraction else random.choice(choices)
+
+    table = pa.table({
+        "a": [value(range(20)) for _ in range(num_rows)],
+        "b": [value(["x", "y", "z"]) for _ in range(num_rows)],
+        "id": [f"{input_id}-{i}" for i in range(num_rows)],
+    }, schema=schema)
+    return table.take(pc.sort_indices(table, sort_keys=sort_by))
+
+
+def batches(table: pa.Table, batch_rows: int) -> Iterator[pa.Table]:
+    for offset in range(0, table.num_rows, batch_rows):
+        yield table.slice(offset, batch_rows)
+
+
+def check(tables: list[pa.Table], inputs: list[Iterator[pa.Table]]):
+    merged = list(merge_sorted(inputs, sort_keys))
+    out = pa.concat_tables(merged) if len(merged) > 0 else schema.empty_table()
+    expected = pa.concat_tables([schema.empty_table()] + tables)
+    expected = expected.take(pc.sort_indices(expected, sort_keys=sort_by))
+    assert out.num_rows == expected.num_rows
+    # every row comes out once, in the sort order (rows that tie can be in any order)
+    assert sorted(out.column("id").to_pylist()) == sorted(expected.column("id").to_pylist())
+    assert out.select(sort_keys).to_pylist() == expected.select(sort_keys).to_pylist()
+
+
+print("============= random sorted inputs ==================")
+for _ in range(100):
+    tables = [sorted_table(i, random.randint(0, 200)) for i in range(random.randint(1, 6))]
+    check(tables, list(map(lambda x: batches(x, random.randint(1, 50)), tables)))
+
+print("============= nulls ==================")
+for _ in range(100):
+    tables = [sorted_table(i, random.randint(0, 100), null_fraction=0.3) for i in range(random.randint(1, 4))]
+    check(tables, list(map(lambda x: batches(x, random.randint(1, 20)), tables)))
+# nulls sort last
+out = pa.concat_tables(list(merge_sorted([iter([pa.table({"a": [1, None], "b": ["x", "x"], "id": ["0-0", "0-1"]},
+                                                          schema=schema)]),
+                                          iter([pa.table({"a": [2], "b": ["x"], "id": ["1-0"]}, schema=schema)])],
+                                         sort_keys)))
+assert out.column("a").to_pylist() == [1, 2, None]
+
+print("============= batch boundaries ==================")
+# one row batches, and empty batches in between
+tables = [sorted_table(i, 50) for i in range(3)]
+check(tables, list(map(lambda x: batches(x, 1), tables)))
+with_empty = list(map(lambda x: iter([x.slice(0, 0), x.slice(0, 10), x.slice(0, 0), x.slice(10)]), tables))
+check(tables, with_empty)
+# batches ending on rows that tie with the next batch of another input
+ties = [pa.table({"a": [1, 1, 1, 2], "b": ["x"] * 4, "id": [f"{i}-{j}" for j in range(4)]}, schema=schema)
+        for i in range(3)]
+check(ties, list(map(lambda x: batches(x, 2), ties)))
+
+print("============= single remaining input ==================")
+# the other inputs run out long before the last one, which is passed through as is
+short = sorted_table(0, 5)
+long = sorted_table(1, 1000)
+check([short, long], [batches(short, 2), batches(long, 100)])
+check([long], [batches(long, 100)])
+check([short, short.slice(0, 0)], [batches(short, 2), iter([])])
+check([], [])
+
+print("============= merging parquet files ==================")
+s3c = S3Client(s3prefix="tenant", s3bucket="testbucket", s3region="us-east-1", s3endpoint="http://localhost:9000",
+               s3accesskey="user", s3secretkey="password")
+ice = IceDBv3(lambda row: "p=1", ["a", "b"], "us-east-1", "user", "password", "http://localhost:9000", s3c, "dan-mbp",
+              row_group_size=64)
+tmp_dir = tempfile.mkdtemp()
+local_paths = []
+tables = []
+for i in range(4):
+    table = sorted_table(i, random.randint(50, 300), null_fraction=0.1)
+    if i == 2:
+        # a column only some of the files have
+        table = table.append_column("extra", pa.array(["e"] * table.num_rows))
+    tables.append(table)
+    local_paths.append(os.path.join(tmp_dir, f"{i}.parquet"))
+    pq.write_table(table, local_paths[-1], row_group_size=37)
+
+merged_path = os.path.join(tmp_dir, "merged.parquet")
+assert ice._IceDBv3__merge_sorted(local_paths, merged_path)
+merged_file = pq.ParquetFile(merged_path)
+merged = merged_file.read()
+assert merged.column_names == ["a", "b", "id", "extra"]
+assert merged.column("extra").null_count == merged.num_rows - tables[2].num_rows
+expected = pa.concat_tables(tables, promote_options="default")
+expected = expected.take(pc.sort_indices(expected, sort_keys=sort_by))
+assert merged.select(sort_keys).to_pylist() == expected.select(sort_keys).to_pylist()
+assert sorted(merged.column("id").to_pylist()) == sorted(expected.column("id").to_pylist())
+# every row group but the last is full
+row_group_rows = list(map(lambda x: merged_file.metadata.row_group(x).num_rows,
+                          range(merged_file.metadata.num_row_groups)))
+assert all(map(lambda x: x == 64, row_group_rows[:-1])) and 0 < row_group_rows[-1] <= 64
+
+# sort orders that are not plain columns fall back to DuckDB
+ice.sort_order = ["a * 2"]
+assert not ice._IceDBv3__merge_sorted(local_paths, os.path.join(tmp_dir, "expression.parquet"))
+
+print("passed!")
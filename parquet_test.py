@@ -0,0 +1,87 @@
+from icedb.parquet import concat_files, read_footer, write_footer, PARQUET_CODECS
+import pyarrow as pa
+import pyarrow.parquet as pq
+import duckdb
+import tempfile
+import struct
+import os
+
+tmp_dir = tempfile.mkdtemp()
+ddb = duckdb.connect()
+
+table = pa.table({
+    "a": list(range(900)),
+    "s": [f"v{i % 7}" for i in range(900)],
+    "l": [[i, None] for i in range(900)],
+    "f": [i / 3 for i in range(900)],
+    "n": [None if i % 3 == 0 else i for i in range(900)],
+})
+
+
+def raw_footer(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        f.seek(-8, 2)
+        length = struct.unpack("<I", f.read(4))[0]
+        f.seek(-8 - length, 2)
+        return f.read(length)
+
+
+print("============= pyarrow files ==================")
+pyarrow_paths = []
+for i in range(3):
+    path = os.path.join(tmp_dir, f"pyarrow_{i}.parquet")
+    pq.write_table(table.slice(i * 300, 300), path, row_group_size=100, compression="snappy", write_page_index=True)
+    pyarrow_paths.append(path)
+    with open(path, 'rb') as f:
+        assert write_footer(read_footer(f)) == raw_footer(path), "footer does not round trip"
+
+out = os.path.join(tmp_dir, "pyarrow_out.parquet")
+assert concat_files(pyarrow_paths, out, PARQUET_CODECS["SNAPPY"])
+assert pq.ParquetFile(out).metadata.num_row_groups == 9
+assert pq.read_table(out).equals(table)
+res = ddb.execute(f"select count(*), sum(a), count(n), count(distinct s) from read_parquet('{out}')").fetchall()
+print(res)
+assert res[0] == (900, sum(range(900)), 600, 7)
+
+print("============= duckdb files ==================")
+duckdb_paths = []
+for i in range(3):
+    path = os.path.join(tmp_dir, f"duckdb_{i}.parquet")
+    ddb.execute(f"copy (select x, 'k' || (x % 5) as s from range({i * 1000}, {(i + 1) * 1000}) r(x)) to '{path}' "
+                f"(format parquet, codec 'zstd', row_group_size 256)")
+    duckdb_paths.append(path)
+    with open(path, 'rb') as f:
+        assert write_footer(read_footer(f)) == raw_footer(path), "footer does not round trip"
+
+out = os.path.join(tmp_dir, "duckdb_out.parquet")
+assert concat_files(duckdb_paths, out, PARQUET_CODECS["ZSTD"])
+res = ddb.execute(f"select count(*), sum(x), count(distinct s) from read_parquet('{out}')").fetchall()
+print(res)
+assert res[0] == (3000, sum(range(3000)), 5)
+read = pq.read_table(out)
+assert read.column("x").to_pylist() == list(range(3000))
+assert read.column("s").to_pylist() == [f"k{x % 5}" for x in range(3000)]
+
+print("============= fallbacks ==================")
+# codec mismatch
+out = os.path.join(tmp_dir, "codec_out.parquet")
+assert not concat_files(pyarrow_paths, out, PARQUET_CODECS["ZSTD"])
+assert not os.path.exists(out)
+
+# schema mismatch
+out = os.path.join(tmp_dir, "schema_out.parquet")
+other_path = os.path.join(tmp_dir, "other.parquet")
+pq.write_table(table.slice(0, 300).drop_columns(["n"]), other_path, row_group_size=100, compression="snappy")
+assert not concat_files([pyarrow_paths[0], other_path], out, PARQUET_CODECS["SNAPPY"])
+assert not os.path.exists(out)
+# files with entirely different columns
+assert not concat_files([pyarrow_paths[0], duckdb_paths[0]], out, PARQUET_CODECS["SNAPPY"])
+assert not os.path.exists(out)
+
+# row groups far below the minimum size
+out = os.path.join(tmp_dir, "small_out.parquet")
+assert not concat_files(pyarrow_paths, out, PARQUET_CODECS["SNAPPY"], min_row_group_rows=101)
+assert not os.path.exists(out)
+assert concat_files(pyarrow_paths, out, PARQUET_CODECS["SNAPPY"], min_row_group_rows=100)
+
+print("passed!")
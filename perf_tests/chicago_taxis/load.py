@@ -32,12 +32,8 @@ csv_headers = [
 flush_limit = 1_000_000
 
 
-def part_func(row: dict) -> str:
-    # Normally you should parse this with datetime package and
-    # verify it, but we know the data is good, so we'll just short circuit it
-    trip_start: int = row['Trip Start Timestamp']
-    dt = datetime.fromtimestamp(float(trip_start/1000))
-    return dt.strftime("d=%Y-%m")
+# Partition with a SQL expression, which runs over the whole batch at once rather than a Python call per row
+part_expr = """strftime(epoch_ms("Trip Start Timestamp"), 'd=%Y-%m')"""
 
 
 s3c = S3Client(s3prefix="chicago_taxis_1m_8k", s3bucket=os.getenv("AWS_S3_BUCKET"), s3region=os.getenv("AWS_S3_REGION"),
@@ -45,7 +41,7 @@ s3c = S3Client(s3prefix="chicago_taxis_1m_8k", s3bucket=os.getenv("AWS_S3_BUCKET
                s3accesskey=os.getenv("AWS_KEY_ID"), s3secretkey=os.getenv("AWS_KEY_SECRET"))
 
 ice = IceDBv3(
-    part_func,
+    part_expr,
     ['"Trip Start Timestamp"'],  # We are doing to sort by event, then timestamp of the event within the data part
     os.getenv("AWS_S3_REGION"),  # This is all local minio stuff
     os.getenv("AWS_KEY_ID"),
@@ -31,8 +31,11 @@ ice = IceDBv3(
 start = time()
 while True:
     s = time()
-    _, _, partition, merged_file_markers, _ = ice.merge(max_file_size=100_000_000, max_file_count=40)
-    if partition is None:
+    # plans every partition from one log read, merges them in parallel, and commits them in one log file
+    new_log, plans, _ = ice.merge_many(max_file_size=100_000_000, max_file_count=40)
+    if new_log is None:
         break
-    print(f"Merged partition {partition} with {len(merged_file_markers)} files in {time()-s} seconds")
+    for plan in plans:
+        print(f"Merged partition {plan.partition} with {len(plan.file_markers)} files")
+    print(f"Merged {len(plans)} partitions in {time()-s} seconds")
 print(f"done in {time()-start} seconds")
\ No newline at end of file
@@ -0,0 +1,87 @@
+from icedb.icedb import IceDBv3, CompressionCodec
+from icedb.log import S3Client, IceLogIO
+from time import time
+from uuid import uuid4
+
+# Rewrites and merges restate the file markers of the log files they tombstone, which must not bring back partitions
+# removed since those log files were written
+
+log = IceLogIO("dan-mbp")
+
+
+def new_table() -> tuple[S3Client, IceDBv3]:
+    # each table uses a new prefix, so previous runs don't affect the state
+    s3c = S3Client(s3prefix=f"removal-{uuid4()}", s3bucket="testbucket", s3region="us-east-1",
+                   s3endpoint="http://localhost:9000", s3accesskey="user", s3secretkey="password")
+    ice = IceDBv3(
+        lambda row: f"p={row['p']}",
+        ['p', 'ts'],
+        "us-east-1",
+        "user",
+        "password",
+        "http://localhost:9000",
+        s3c,
+        "dan-mbp",
+        s3_use_path=True,
+        compression_codec=CompressionCodec.ZSTD
+    )
+    return s3c, ice
+
+
+def alive_files(s3c: S3Client) -> list:
+    _, file_markers, _, _ = log.read_at_max_time(s3c, round(time() * 1000))
+    return list(filter(lambda x: x.tombstone is None, file_markers))
+
+
+def alive_partitions(s3c: S3Client) -> list[str]:
+    return sorted(set(map(lambda x: x.path.split("/")[-2], alive_files(s3c))))
+
+
+print("============= rewrite after partition removal ==================")
+s3c, ice = new_table()
+# both partitions are in the same log file
+ice.insert([
+    {"p": 1, "ts": 1, "event": "keep"},
+    {"p": 1, "ts": 2, "event": "drop"},
+    {"p": 2, "ts": 3, "event": "keep"},
+])
+assert alive_partitions(s3c) == ["p=1", "p=2"]
+
+new_log, meta, deleted = ice.remove_partitions(lambda partitions: ["p=2"])
+print(f"partition removal deleted {deleted} files with the new log path {new_log}")
+assert alive_partitions(s3c) == ["p=1"]
+
+# the rewrite tombstones the log file of p=1, which also holds the removed p=2 file
+new_log, meta, rewritten = ice.rewrite_partition("p=1", "select * from _rows where event != 'drop'")
+print(f"partition rewrite rewrote files {rewritten} with the new log path {new_log}")
+assert alive_partitions(s3c) == ["p=1"], "the removed partition must stay removed"
+
+files = alive_files(s3c)
+assert len(files) == 1
+assert files[0].path not in rewritten
+
+print("============= merge after partition removal ==================")
+s3c, ice = new_table()
+# both partitions are in the same log file, and p=1 gets a second file to merge with
+ice.insert([
+    {"p": 1, "ts": 1, "event": "keep"},
+    {"p": 2, "ts": 2, "event": "keep"},
+])
+ice.insert([{"p": 1, "ts": 3, "event": "keep"}])
+assert alive_partitions(s3c) == ["p=1", "p=2"]
+
+new_log, meta, deleted = ice.remove_partitions(lambda partitions: ["p=2"])
+print(f"partition removal deleted {deleted} files with the new log path {new_log}")
+assert alive_partitions(s3c) == ["p=1"]
+
+# the merge tombstones both insert log files, the first of which also holds the removed p=2 file
+new_log, plans, meta = ice.merge_many()
+print(f"merged {plans} with the new log path {new_log}")
+assert len(plans) == 1
+assert alive_partitions(s3c) == ["p=1"], "the removed partition must stay removed"
+
+files = alive_files(s3c)
+assert len(files) == 1
+assert files[0].path == plans[0].new_file_marker.path
+
+print("passed!")